@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+from heapq import heappush, heappop
+from itertools import count
+from math import ceil
+from gevent import Timeout
+from gevent.event import Event
+from time import time
+
+# Overloaded is raised instead of running a job, status is 413 (the job can never fit),
+# 429 (too many jobs waiting) or 503 (waited too long), retry_after is in seconds
+class Overloaded(Exception):
+    def __init__(self, status: int, message: str, retry_after: int = 0):
+        super(Overloaded, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+# Admission runs jobs only while the sum of their estimated peak memory stays within budget.
+# Other jobs wait in a priority queue, cheapest estimated compute first and FIFO among equals.
+# At most max_queue jobs wait, for at most max_wait seconds each.
+class Admission(object):
+    def __init__(self, budget: int, max_queue: int, max_wait: float):
+        self.budget = budget
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.used = 0
+        self.running = 0
+        self.queue = []# heap of [priority, seq, memory, event], memory is None once given up
+        self.waiting = 0
+        self.seq = count()
+        self.job_sec = 1.0# moving average of job durations, for Retry-After
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "timeouts": 0, "wait_sec": 0.0}
+
+    def retry_after(self) -> int:
+        return max(ceil(self.job_sec * (self.waiting + 1) / max(self.running, 1)), 1)
+
+    def acquire(self, memory: int, priority: float) -> None:
+        if memory > self.budget:
+            self.stats["rejected"] += 1
+            raise Overloaded(413, "image too large for the memory budget")
+        if not self.waiting and self.used + memory <= self.budget: return self._admit(memory)
+        if self.waiting >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise Overloaded(429, "too many queued jobs", self.retry_after())
+        item = [priority, next(self.seq), memory, Event()]
+        heappush(self.queue, item)
+        self.stats["queued"] += 1
+        self.waiting += 1
+        t = time()
+        try:
+            with Timeout(self.max_wait, False): item[3].wait()
+        except BaseException:# e.g. the request greenlet was killed
+            if item[3].is_set(): self.release(memory, 0)
+            raise
+        finally:
+            self.stats["wait_sec"] += time() - t
+            if not item[3].is_set():
+                item[2] = None# still queued, release skips it
+                self.waiting -= 1
+        if item[3].is_set(): return# admitted by release, memory already counted
+        self.stats["timeouts"] += 1
+        raise Overloaded(503, "server busy", self.retry_after())
+
+    def _admit(self, memory: int) -> None:
+        self.used += memory
+        self.running += 1
+        self.stats["admitted"] += 1
+
+    def release(self, memory: int, sec: float) -> None:
+        self.used -= memory
+        self.running -= 1
+        self.job_sec = self.job_sec * 0.8 + sec * 0.2
+        while self.queue:
+            _, _, m, ev = self.queue[0]
+            if m == None: heappop(self.queue)
+            elif self.used + m <= self.budget:
+                heappop(self.queue)
+                self.waiting -= 1
+                self._admit(m)
+                ev.set()
+            else: break
+
+    @contextmanager
+    def slot(self, memory: int, priority: float):
+        self.acquire(memory, priority)
+        t = time()
+        try: yield
+        finally: self.release(memory, time() - t)
+
+    def info(self) -> dict:
+        return {**self.stats, "used": self.used, "budget": self.budget, "running": self.running, "waiting": self.waiting}
@@ -0,0 +1,167 @@
+from cv2 import imdecodeanimation, VideoCapture, cvtColor, CAP_FFMPEG, CAP_PROP_FPS, CAP_PROP_FRAME_WIDTH, CAP_PROP_FRAME_HEIGHT, CAP_PROP_FRAME_COUNT, COLOR_BGR2RGB, COLOR_BGRA2RGB
+from numpy import frombuffer, uint8, array_equal
+from struct import unpack_from
+from tempfile import NamedTemporaryFile
+from contextlib import contextmanager
+from ingest import probe, downsize
+from encoder import WebpAnimStream, VideoStream
+
+# Animated gif/webp/png and videos are upscaled frame by frame: frames are decoded lazily,
+# identical consecutive frames are computed once, distinct ones are batched through the
+# model and every output frame is appended to the output file right away. Memory depends
+# on the frame size and the batch, never on the length of the clip.
+
+# output formats of animations besides animated webp, format -> (extension, mimetype)
+FORMATS = {"webm": (".webm", "video/webm")}
+# frames of an animated image decoded per call, in bytes of decoded frames
+CHUNK_BYTES = 64 << 20
+# fps of videos made from animated images
+FPS = 25
+
+def _gif_frames(data) -> int:
+    n, i = 0, 13
+    if len(data) > 10 and data[10] & 0x80: i += 3 << ((data[10] & 7) + 1)# global color table
+    while i < len(data):
+        b = data[i]
+        if b == 0x3B: break# trailer
+        if b == 0x21: i += 2# extension, label
+        elif b == 0x2C:
+            n += 1
+            flags = data[i + 9] if i + 9 < len(data) else 0
+            i += 10 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0) + 1# descriptor, local color table, lzw size
+        else: break
+        while i < len(data) and data[i]: i += data[i] + 1# sub blocks
+        i += 1
+    return n
+
+def _webp_frames(data) -> int:
+    n, i = 0, 12
+    while i + 8 <= len(data):
+        kind, size = data[i:i + 4], unpack_from("<I", data, i + 4)[0]
+        if kind == b"ANMF": n += 1
+        i += 8 + size + (size & 1)
+    return n
+
+def _png_frames(data) -> int:
+    i = 8
+    while i + 8 <= len(data):
+        size, kind = unpack_from(">I", data, i)[0], data[i + 4:i + 8]
+        if kind == b"acTL": return unpack_from(">I", data, i + 8)[0]
+        if kind == b"IDAT": return 1
+        i += 12 + size
+    return 1
+
+# loop count of an animated gif, webp or png read from the container (0 loops forever), as
+# imdecodeanimation reports it but without decoding a frame
+def _loop_count(data) -> int:
+    head = bytes(data[:16])
+    if head.startswith(b"GIF8"):
+        i = bytes(data[:1 << 16]).find(b"NETSCAPE2.0")# application extension, before the first image
+        if i < 0 or i + 15 > len(data): return 1# played once
+        n = unpack_from("<H", data, i + 13)[0]# repeats after the first play
+        return n + 1 if n else 0
+    if head[:4] == b"RIFF":
+        i = 12
+        while i + 8 <= len(data):
+            kind, size = data[i:i + 4], unpack_from("<I", data, i + 4)[0]
+            if kind == b"ANIM": return unpack_from("<H", data, i + 12)[0]
+            i += 8 + size + (size & 1)
+        return 0
+    i = 8
+    while i + 8 <= len(data):
+        size, kind = unpack_from(">I", data, i)[0], data[i + 4:i + 8]
+        if kind == b"acTL": return unpack_from(">I", data, i + 12)[0]
+        if kind == b"IDAT": break
+        i += 12 + size
+    return 0
+
+# ("image", frames) for animated gif, webp and png, ("video", 0) for mp4/mov, webm/mkv and avi,
+# None for still images. Frames are counted from the container without decoding.
+def animation(data) -> tuple:
+    head = bytes(data[:16])
+    n = 0
+    if head.startswith(b"GIF8"): n = _gif_frames(data)
+    elif head[:4] == b"RIFF" and head[8:12] == b"WEBP" and head[12:16] == b"VP8X": n = _webp_frames(data)
+    elif head.startswith(b"\x89PNG\r\n\x1a\n"): n = _png_frames(data)
+    elif head[4:8] == b"ftyp" and head[8:12] not in (b"avif", b"avis", b"heic", b"heix", b"mif1", b"msf1"): return "video", 0
+    elif head.startswith(b"\x1a\x45\xdf\xa3") or (head[:4] == b"RIFF" and head[8:12] == b"AVI "): return "video", 0
+    return ("image", n) if n > 1 else None
+
+@contextmanager
+def _capture(data):
+    with NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        cap = VideoCapture(f.name, CAP_FFMPEG)
+        try: yield cap
+        finally: cap.release()
+
+# (width, height, frames, fps, loop count) of an animation, fps is 0 for images and
+# frames of videos are estimated by the container. Images are not decoded.
+def info(data, kind: str, frames: int = 0) -> tuple:
+    if kind == "image":
+        w, h = probe(data) or (0, 0)
+        return w, h, frames, 0, _loop_count(data)
+    with _capture(data) as cap:
+        if not cap.isOpened(): return 0, 0, 0, 0, 0
+        return int(cap.get(CAP_PROP_FRAME_WIDTH)), int(cap.get(CAP_PROP_FRAME_HEIGHT)), max(int(cap.get(CAP_PROP_FRAME_COUNT)), 0), cap.get(CAP_PROP_FPS) or FPS, 0
+
+def _rgb(frame, size):
+    frame = cvtColor(frame, COLOR_BGRA2RGB if frame.shape[2] == 4 else COLOR_BGR2RGB)
+    return frame if size == None else downsize(frame, size)
+
+# yields (rgb cv2 image, duration in ms) for every frame, resized to size (w, h) if given.
+# Animated images are decoded CHUNK_BYTES at a time, videos one frame at a time.
+def frames(data, kind: str, size: tuple = None):
+    if kind == "image":
+        buf = frombuffer(data, uint8)
+        w, h = probe(data) or (1, 1)
+        count = max(CHUNK_BYTES // (w * h * 4), 1)
+        start = 0
+        while True:
+            ok, a = imdecodeanimation(buf, start, count)
+            if not ok: break
+            for frame, ms in zip(a.frames, a.durations): yield _rgb(frame, size), int(ms)
+            if len(a.frames) < count: break
+            start += count
+            del a
+        return
+    with _capture(data) as cap:
+        ms = 1000 / (cap.get(CAP_PROP_FPS) or FPS)
+        while True:
+            ok, frame = cap.read()
+            if not ok: break
+            yield _rgb(frame, size), ms
+
+# seekable file f or path, result has write(bgr frame, duration), extend(duration) and close()
+def writer(f, path: str, fmt: tuple, width: int, height: int, fps: float, loop: int):
+    if fmt[0] == "webm": return VideoStream(path, width, height, fps or FPS)
+    return WebpAnimStream(f, width, height, loop, fmt[1], fmt[2])
+
+# m is a RealWaifuUpScaler, src yields (rgb frame, duration), out is a writer.
+# Up to batch distinct frames run in one forward pass, at most max_frames are read.
+# result is the number of frames read, upscaled and skipped as identical to the previous one.
+def upscale(m, src, out, tile, batch: int = 4, max_frames: int = 0, **opts) -> dict:
+    stats = {"frames": 0, "upscaled": 0, "skipped": 0}
+    pending, durations, prev = [], [], None
+    def flush():
+        res = m.batch(pending, tile, **opts) if len(pending) > 1 else [m(pending[0], tile, **opts)]
+        for img, ms in zip(res, durations): out.write(img[:, :, ::-1], ms)
+        stats["upscaled"] += len(pending)
+        pending.clear()
+        durations.clear()
+    for frame, ms in src:
+        if max_frames and stats["frames"] >= max_frames: break
+        stats["frames"] += 1
+        if prev is not None and array_equal(prev, frame):
+            stats["skipped"] += 1
+            if durations: durations[-1] += ms
+            else: out.extend(ms)
+            continue
+        prev = frame
+        pending.append(frame)
+        durations.append(ms)
+        if len(pending) >= batch: flush()
+    if pending: flush()
+    out.close()
+    return stats
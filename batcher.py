@@ -0,0 +1,56 @@
+from gevent import spawn, sleep
+from gevent.event import AsyncResult
+from time import time
+
+# Batcher gathers frames submitted under the same key within window seconds
+# and runs them as one batch through run(key, frames) -> results.
+# key must already contain everything that makes frames stackable (model, tile, shape).
+class Batcher(object):
+    def __init__(self, run, window: float, max_batch: int):
+        self.run = run
+        self.window = window
+        self.max_batch = max_batch
+        self.queues = {}
+        self.stats = {"batches": 0, "frames": 0, "max_size": 0, "wait_sec": 0.0, "compute_sec": 0.0, "last": {}}
+
+    def submit(self, key, frame):
+        if self.window <= 0 or self.max_batch <= 1:
+            return self._run(key, [(frame, None, time())])[0]
+        r = AsyncResult()
+        q = self.queues.get(key)
+        if q == None:
+            q = self.queues[key] = []
+            spawn(self._later, key, q)
+        q.append((frame, r, time()))
+        if len(q) >= self.max_batch:
+            del self.queues[key]
+            spawn(self._run, key, q)
+        return r.get()
+
+    def _later(self, key, q: list):
+        sleep(self.window)
+        # q may have been flushed already because it was full
+        if self.queues.get(key) is q:
+            del self.queues[key]
+            self._run(key, q)
+
+    def _run(self, key, q: list) -> list:
+        t0 = time()
+        try: results = self.run(key, [f for f, _, _ in q])
+        except Exception as e:
+            for _, r, _ in q:
+                if r != None: r.set_exception(e)
+            if q[0][1] == None: raise
+            return []
+        t1 = time()
+        wait = sum(t0 - t for _, _, t in q)
+        st = self.stats
+        st["batches"] += 1
+        st["frames"] += len(q)
+        st["max_size"] = max(st["max_size"], len(q))
+        st["wait_sec"] += wait
+        st["compute_sec"] += t1 - t0
+        st["last"] = {"key": str(key), "size": len(q), "wait_sec": wait / len(q), "compute_sec": t1 - t0}
+        for (_, r, _), res in zip(q, results):
+            if r != None: r.set(res)
+        return results
@@ -0,0 +1,94 @@
+from argparse import ArgumentParser
+from itertools import product
+from json import dump, load
+from time import time
+from upcunet_v3 import RealWaifuUpScaler, UpCunet2x, UpCunet3x, UpCunet4x
+from quant import bf16_supported, quantize_int8
+from metrics import reset_peak_rss, peak_rss
+import numpy as np
+import torch
+
+# Sweeps scale x tile mode x resolution x threads x precision over synthetic frames and
+# randomly initialized weights (seeded, no .pth files needed), prints the results as json
+# and compares them against a stored baseline.
+# usage: python bench.py [--scales 2,3,4] [--tiles 0,2] [--sizes 256x256] [--threads 4]
+#                        [--precisions fp32] [--repeat 5] [--out now.json] [--baseline base.json]
+
+NETS = {2: UpCunet2x, 3: UpCunet3x, 4: UpCunet4x}
+
+def _list(conv):
+    return lambda s: [conv(v) for v in s.split(",") if v]
+
+def _size(s: str) -> tuple:
+    w, h = s.lower().split("x")
+    return int(w), int(h)
+
+def upscaler(scale: int, precision: str, frame) -> RealWaifuUpScaler:
+    torch.manual_seed(0)
+    m = RealWaifuUpScaler(scale, None, half=False, device="cpu", weight=NETS[scale]().state_dict())
+    if precision == "bf16": m.autocast = torch.bfloat16
+    elif precision == "int8": quantize_int8(m.model, frames=[frame])
+    return m
+
+def percentile(v: list, p: float) -> float:
+    return float(np.percentile(v, p))
+
+def run(scale: int, tile: int, size: tuple, threads: int, precision: str, repeat: int) -> dict:
+    torch.set_num_threads(threads)
+    w, h = size
+    frame = np.random.default_rng(0).integers(0, 256, (h, w, 3), np.uint8)
+    m = upscaler(scale, precision, frame)
+    m(frame, tile)# warm up
+    reset_peak_rss()
+    lat = []
+    for _ in range(repeat):
+        t = time()
+        m(frame, tile)
+        lat.append(time() - t)
+    return {"scale": scale, "tile": tile, "size": f"{w}x{h}", "threads": threads, "precision": precision,
+            "p50_sec": percentile(lat, 50), "p99_sec": percentile(lat, 99),
+            "images_per_sec": repeat / sum(lat), "mpix_per_sec": repeat * w * h / sum(lat) / 1e6,
+            "peak_rss_bytes": peak_rss()}
+
+def key(r: dict) -> tuple:
+    return r["scale"], r["tile"], r["size"], r["threads"], r["precision"]
+
+# a result regresses when its p50 latency or its peak memory grew more than tolerance
+def compare(results: list, baseline: list, tolerance: float) -> list:
+    base = {key(r): r for r in baseline}
+    flagged = []
+    for r in results:
+        b = base.get(key(r))
+        if b == None: continue
+        r["baseline_p50_sec"] = b["p50_sec"]
+        r["regressions"] = [k for k in ["p50_sec", "peak_rss_bytes"] if r[k] > b[k] * (1 + tolerance)]
+        if r["regressions"]: flagged.append(r)
+    return flagged
+
+if __name__ == "__main__":
+    p = ArgumentParser(description="benchmark the upscalers on synthetic inputs")
+    p.add_argument("--scales", type=_list(int), default=[2, 3, 4])
+    p.add_argument("--tiles", type=_list(int), default=[0, 2])
+    p.add_argument("--sizes", type=_list(_size), default=[(256, 256)])
+    p.add_argument("--threads", type=_list(int), default=[torch.get_num_threads()])
+    p.add_argument("--precisions", type=_list(str), default=["fp32"])
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--out", help="write the results to this json file")
+    p.add_argument("--baseline", help="json file of an earlier run to compare against")
+    p.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown, default 10%%")
+    a = p.parse_args()
+    results = []
+    for scale, tile, size, threads, precision in product(a.scales, a.tiles, a.sizes, a.threads, a.precisions):
+        if precision == "bf16" and not bf16_supported(): continue
+        try: r = run(scale, tile, size, threads, precision, a.repeat)
+        except RuntimeError as e: r = {"scale": scale, "tile": tile, "size": f"{size[0]}x{size[1]}", "threads": threads, "precision": precision, "error": str(e).splitlines()[0]}
+        results.append(r)
+        print(r, flush=True)
+    flagged = []
+    if a.baseline:
+        with open(a.baseline) as f: flagged = compare([r for r in results if "error" not in r], load(f)["results"], a.tolerance)
+    report = {"torch": torch.__version__, "results": results, "regressions": len(flagged)}
+    if a.out:
+        with open(a.out, "w") as f: dump(report, f, indent=1)
+    for r in flagged: print("REGRESSION", key(r), r["regressions"], f"p50 {r['baseline_p50_sec']:.3f}s -> {r['p50_sec']:.3f}s")
+    exit(1 if flagged else 0)
@@ -0,0 +1,214 @@
+from collections import OrderedDict
+from os import makedirs, replace, remove, scandir, getpid, stat
+from os.path import join, exists
+from time import time
+from hashlib import sha256
+try: from xxhash import xxh3_128
+except ImportError: xxh3_128 = None
+
+# cache keys are 128 bit digests of parts fed one after another, no joined copy of the data
+# is made. xxh3 is used when xxhash is installed, otherwise sha256 (hardware accelerated on
+# most cpus, faster than md5 and blake2b there) cut to the same 32 hex chars.
+def digest(*parts) -> str:
+    h = xxh3_128() if xxh3_128 != None else sha256()
+    for p in parts: h.update(p)
+    return h.hexdigest()[:32]
+
+def _is_key(name: str) -> bool:
+    return len(name) == 32 and all(c in "0123456789abcdef" for c in name)
+
+# MemoryCache is a LRU of key -> bytes bounded by total bytes. Entries are dropped ttl
+# seconds after they were created (0 keeps them), like the files of DiskCache. meta is kept
+# with the data and leaves with it.
+class MemoryCache(object):
+    def __init__(self, max_bytes: int, max_item: int, ttl: float = 0):
+        self.max_bytes = max_bytes
+        self.max_item = max_item
+        self.ttl = ttl
+        self.size = 0
+        self.items = OrderedDict()# key -> (data, created, meta)
+
+    def get(self, key: str):
+        v = self.entry(key)
+        return None if v == None else v[0]
+
+    # (data, created, meta) of key or None
+    def entry(self, key: str):
+        v = self.items.get(key)
+        if v == None: return None
+        if self.ttl > 0 and time() - v[1] > self.ttl:
+            self.drop(key)
+            return None
+        self.items.move_to_end(key)
+        return v
+
+    # created is when data was made, now if not given
+    def put(self, key: str, data: bytes, created: float = None, meta=None) -> None:
+        if len(data) > self.max_item or len(data) > self.max_bytes: return
+        self.drop(key)
+        self.items[key] = (data, time() if created == None else created, meta)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (old, _, _) = self.items.popitem(last=False)
+            self.size -= len(old)
+
+    def drop(self, key: str) -> None:
+        v = self.items.pop(key, None)
+        if v != None: self.size -= len(v[0])
+
+# DiskCache stores key files in root/<key[:2]>/<key> and keeps an in-memory LRU index of
+# key -> (size, mtime) so that lookups and eviction never touch the filesystem.
+# The index is rebuilt from the directory on boot, oldest files evicted first.
+# on_drop(key) is called for every key that expired or was evicted.
+class DiskCache(object):
+    def __init__(self, root: str, max_bytes: int, ttl: float, on_drop=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_drop = on_drop
+        self.size = 0
+        self.index = OrderedDict()
+        makedirs(root, 0o755, exist_ok=True)
+        self.warm()
+
+    def path(self, key: str) -> str:
+        return join(self.root, key[:2], key)
+
+    def warm(self) -> None:
+        found = []
+        with scandir(self.root) as it:
+            for e in it:
+                if e.is_file() and _is_key(e.name):
+                    # files of the old flat layout are moved into their shard
+                    makedirs(join(self.root, e.name[:2]), 0o755, exist_ok=True)
+                    replace(e.path, self.path(e.name))
+                    st = stat(self.path(e.name))
+                    found.append((st.st_mtime, e.name, st.st_size))
+                elif e.is_dir() and len(e.name) == 2:
+                    with scandir(e.path) as shard:
+                        for f in shard:
+                            if f.name.endswith((".tmp", ".tmp.webm")): remove(f.path) # interrupted writes
+                            elif _is_key(f.name):
+                                st = f.stat()
+                                found.append((st.st_mtime, f.name, st.st_size))
+        found.sort()
+        for mtime, key, size in found:
+            self.index[key] = (size, mtime)
+            self.size += size
+        self.evict()
+
+    def _expired(self, mtime: float) -> bool:
+        return self.ttl > 0 and time() - mtime > self.ttl
+
+    # result is the path of the cached file or None
+    def get(self, key: str):
+        v = self.index.get(key)
+        if v == None: return None
+        if self._expired(v[1]):
+            self.drop(key)
+            return None
+        self.index.move_to_end(key)
+        return self.path(key)
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes: return
+        tmp = self.temp(key)
+        with open(tmp, "wb") as f: f.write(data)
+        self.adopt(key, tmp)
+
+    # a path to write key to before adopting it, removed on boot if never adopted
+    def temp(self, key: str, tag: str = "") -> str:
+        makedirs(join(self.root, key[:2]), 0o755, exist_ok=True)
+        return f"{self.path(key)}.{getpid()}{tag}.tmp"
+
+    # moves a finished temp file into the cache as key
+    def adopt(self, key: str, tmp: str) -> None:
+        size = stat(tmp).st_size
+        if size > self.max_bytes: return remove(tmp)
+        replace(tmp, self.path(key))
+        if key in self.index: self.size -= self.index.pop(key)[0]
+        self.index[key] = (size, time())
+        self.size += size
+        self.evict()
+
+    def drop(self, key: str) -> None:
+        size, _ = self.index.pop(key)
+        self.size -= size
+        m = self.path(key)
+        if exists(m): remove(m)
+        if self.on_drop != None: self.on_drop(key)
+
+    def evict(self) -> None:
+        while self.size > self.max_bytes and self.index:
+            self.drop(next(iter(self.index)))
+
+# ResultCache puts a MemoryCache for hot outputs in front of a DiskCache.
+# get returns bytes (memory hit), a file path (disk hit) or None.
+# Both tiers expire after ttl and a file dropped from disk is dropped from memory too.
+class ResultCache(object):
+    def __init__(self, root: str, disk_bytes: int, mem_bytes: int, mem_item: int, ttl: float):
+        self.mem = MemoryCache(mem_bytes, mem_item, ttl)
+        self.disk = DiskCache(root, disk_bytes, ttl, self.mem.drop)
+        self.stats = {"mem_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def get(self, key: str):
+        data = self.mem.get(key)
+        if data != None:
+            self.stats["mem_hits"] += 1
+            return data
+        m = self.disk.get(key)
+        if m == None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["disk_hits"] += 1
+        # small files are promoted so the next hit is served from memory
+        size, mtime = self.disk.index[key]
+        if size <= self.mem.max_item:
+            with open(m, "rb") as f: data = f.read()
+            self.mem.put(key, data, mtime)
+            return data
+        return m
+
+    def put(self, key: str, data: bytes) -> None:
+        self.mem.put(key, data)
+        self.disk.put(key, data)
+
+    # outputs streamed into a temp file of the disk tier
+    def adopt(self, key: str, tmp: str) -> None:
+        self.disk.adopt(key, tmp)
+
+    def info(self) -> dict:
+        return {**self.stats, "mem_bytes": self.mem.size, "mem_items": len(self.mem.items),
+                "disk_bytes": self.disk.size, "disk_items": len(self.disk.index)}
+
+# UrlIndex maps a normalized url plus the request parameters to the result key of the
+# image downloaded from it, so a repeated url is answered from the ResultCache without
+# touching the network. After ttl seconds the url is downloaded (revalidated) again.
+class UrlIndex(object):
+    def __init__(self, ttl: float, max_items: int):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0}
+
+    def get(self, url: str):
+        v = self.items.get(url)
+        if v == None:
+            self.stats["misses"] += 1
+            return None
+        if time() - v[1] > self.ttl:
+            del self.items[url]
+            self.stats["expired"] += 1
+            return None
+        self.items.move_to_end(url)
+        self.stats["hits"] += 1
+        return v[0]
+
+    def put(self, url: str, key: str) -> None:
+        if self.ttl <= 0 or self.max_items <= 0: return
+        self.items.pop(url, None)
+        self.items[url] = (key, time())
+        while len(self.items) > self.max_items: self.items.popitem(last=False)
+
+    def info(self) -> dict:
+        return {**self.stats, "items": len(self.items)}
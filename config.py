@@ -0,0 +1,86 @@
+from os import environ, cpu_count
+
+def _ram() -> int:
+    try:
+        from os import sysconf
+        return sysconf("SC_PAGE_SIZE") * sysconf("SC_PHYS_PAGES")
+    except (ImportError, ValueError, OSError): return 16 << 30
+
+# all settings can be overridden by environment variables of the same name with prefix CUGAN_
+def _get(key: str, default, conv=str):
+    v = environ.get("CUGAN_"+key)
+    return default if v == None else conv(v)
+
+# seconds to wait for more same-shape frames before running a batch, 0 disables batching
+BATCH_WINDOW = _get("BATCH_WINDOW", 0.01, float)
+# max frames stacked into one forward pass
+BATCH_MAX = _get("BATCH_MAX", 8, int)
+# result cache directory and byte budgets of the disk and memory tiers
+CACHE_DIR = _get("CACHE_DIR", "tmp")
+CACHE_DISK_BYTES = _get("CACHE_DISK_BYTES", 8 << 30, int)
+CACHE_MEM_BYTES = _get("CACHE_MEM_BYTES", 256 << 20, int)
+# outputs larger than this stay on disk only and are streamed from there
+CACHE_MEM_ITEM = _get("CACHE_MEM_ITEM", 2 << 20, int)
+# seconds a cached result stays valid, 0 means forever
+CACHE_TTL = _get("CACHE_TTL", 0, float)
+# max number of weight files kept loaded, least recently used ones are dropped
+MODEL_MAX = _get("MODEL_MAX", 4, int)
+# comma separated weight files or globs loaded at startup
+MODEL_PRELOAD = _get("MODEL_PRELOAD", "")
+# load weights from the mapped .safetensors next to a .pth when there is one (see weights.py)
+MMAP_WEIGHTS = _get("MMAP_WEIGHTS", 1, int)
+# number of inference worker processes, 0 runs inference inside the server process
+WORKERS = _get("WORKERS", 1, int)
+# torch intra-op threads of every worker
+WORKER_THREADS = _get("WORKER_THREADS", max((cpu_count() or 1) // max(WORKERS, 1), 1), int)
+# peak memory budget in bytes of one image when tile=auto
+TILE_BUDGET = _get("TILE_BUDGET", 4 << 30, int)
+# threads running the tiles of one image concurrently, the worker's torch threads are split between them
+TILE_WORKERS = _get("TILE_WORKERS", 1, int)
+# max tiles stacked into one batch in tiled mode, lowered further to keep within TILE_BUDGET
+TILE_BATCH = _get("TILE_BATCH", 4, int)
+# share of the tiles whose SE means are used for the whole image with fast=1, see se_sample.py
+SE_SAMPLE = _get("SE_SAMPLE", 0.25, float)
+# estimated peak memory all running jobs may use together, 3/4 of the ram by default,
+# jobs beyond it wait (at most ADMIT_QUEUE of them, ADMIT_WAIT seconds each)
+ADMIT_BUDGET = _get("ADMIT_BUDGET", _ram() * 3 // 4, int)
+ADMIT_QUEUE = _get("ADMIT_QUEUE", 64, int)
+ADMIT_WAIT = _get("ADMIT_WAIT", 60, float)
+# inputs with more pixels are rejected with 413, or downsized to fit with OVERSIZE=downsize.
+# The size is read from the png/jpeg/webp/gif/bmp header before anything is decoded.
+MAX_PIXELS = _get("MAX_PIXELS", 4096 * 4096, int)
+OVERSIZE = _get("OVERSIZE", "reject")
+# inputs with more pixels are always rejected, even with OVERSIZE=downsize
+MAX_DECODE_PIXELS = _get("MAX_DECODE_PIXELS", 16384 * 16384, int)
+# animations (gif/webp/png) and videos with more frames are rejected with 413,
+# distinct frames of an animation are upscaled ANIM_BATCH at a time
+MAX_FRAMES = _get("MAX_FRAMES", 1000, int)
+ANIM_BATCH = _get("ANIM_BATCH", 4, int)
+# max images of one /scale/batch request and how many of its cache misses run at once
+BATCH_ITEMS = _get("BATCH_ITEMS", 256, int)
+BATCH_PARALLEL = _get("BATCH_PARALLEL", 16, int)
+# directory of the jobs of /jobs, seconds a finished job is kept and jobs running at once
+JOBS_DIR = _get("JOBS_DIR", "jobs")
+JOBS_KEEP = _get("JOBS_KEEP", 86400, float)
+JOBS_RUNNERS = _get("JOBS_RUNNERS", max(WORKERS, 1), int)
+# times a job waits for a busy server (429/503) before it fails
+JOBS_RETRIES = _get("JOBS_RETRIES", 20, int)
+# inference engine, eager or jit (traced and frozen graphs, see engine.py)
+ENGINE = _get("ENGINE", "eager")
+# directory of the compiled jit graphs
+ENGINE_DIR = _get("ENGINE_DIR", "engines")
+# fp32, bf16 (cpu autocast) or int8 (statically quantized convs, see quant.py)
+PRECISION = _get("PRECISION", "fp32")
+# seconds to connect and between reads of GET /scale?url= downloads
+FETCH_CONNECT_TIMEOUT = _get("FETCH_CONNECT_TIMEOUT", 5, float)
+FETCH_READ_TIMEOUT = _get("FETCH_READ_TIMEOUT", 30, float)
+# downloads larger than this are dropped while streaming
+FETCH_MAX_BYTES = _get("FETCH_MAX_BYTES", 32 << 20, int)
+# seconds a download is reused without asking the upstream, and the byte budget of those downloads
+FETCH_CACHE_TTL = _get("FETCH_CACHE_TTL", 60, float)
+FETCH_CACHE_BYTES = _get("FETCH_CACHE_BYTES", 128 << 20, int)
+# seconds a url keeps pointing at the result of its last download, and max urls remembered
+URL_CACHE_TTL = _get("URL_CACHE_TTL", 600, float)
+URL_CACHE_ITEMS = _get("URL_CACHE_ITEMS", 100000, int)
+# threads encoding outputs, encoding runs beside inference and the http loop
+ENCODE_THREADS = _get("ENCODE_THREADS", 2, int)
@@ -0,0 +1,157 @@
+from numpy import zeros, full, concatenate, uint8
+from struct import pack, unpack_from
+from os import replace
+from zlib import compressobj, crc32, Z_SYNC_FLUSH
+from cv2 import imencode, VideoWriter, VideoWriter_fourcc, IMWRITE_WEBP_QUALITY, IMWRITE_PNG_COMPRESSION, IMWRITE_JPEG_QUALITY, IMWRITE_JPEG_OPTIMIZE, IMWRITE_AVIF_QUALITY, IMWRITE_AVIF_SPEED
+
+# format -> (extension, mimetype), the first one is the default output
+FORMATS = {"webp": (".webp", "image/webp"), "avif": (".avif", "image/avif"), "jpeg": (".jpg", "image/jpeg"), "png": (".png", "image/png")}
+MIMETYPES = {mime: fmt for fmt, (_, mime) in FORMATS.items()}
+
+# quality is 1-100 and effort 0-9 (more is smaller but slower) for every format, None keeps
+# the codec default. webp only has quality in cv2, png only has effort (zlib level),
+# jpeg optimizes its huffman tables from effort 5, avif maps effort to speed 9-0.
+def params(fmt: str, quality: int = None, effort: int = None) -> list:
+    p = []
+    if quality != None:
+        if fmt == "webp": p += [IMWRITE_WEBP_QUALITY, quality]
+        elif fmt == "jpeg": p += [IMWRITE_JPEG_QUALITY, quality]
+        elif fmt == "avif": p += [IMWRITE_AVIF_QUALITY, quality]
+    if effort != None:
+        if fmt == "png": p += [IMWRITE_PNG_COMPRESSION, effort]
+        elif fmt == "jpeg": p += [IMWRITE_JPEG_OPTIMIZE, int(effort >= 5)]
+        elif fmt == "avif": p += [IMWRITE_AVIF_SPEED, 9 - effort]
+    return p
+
+# frame is a bgr cv2 image, result is the encoded data, empty on failure
+def encode(frame, fmt: str = "webp", quality: int = None, effort: int = None) -> bytes:
+    ok, data = imencode(FORMATS[fmt][0], frame, params(fmt, quality, effort))
+    return data.tobytes() if ok else b""
+
+# PngStream writes a rgb png to f band by band, so the output is never held whole.
+# Rows use the Up filter and every band is sync flushed, so a reader can decode
+# everything written so far.
+class PngStream(object):
+    def __init__(self, f, width: int, height: int, effort: int = None):
+        self.f = f
+        self.z = compressobj(6 if effort == None else effort)
+        self.prev = zeros((1, width * 3), uint8)
+        f.write(b"\x89PNG\r\n\x1a\n")
+        self.chunk(b"IHDR", pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        f.flush()
+
+    def chunk(self, kind: bytes, data: bytes) -> None:
+        self.f.write(pack(">I", len(data)) + kind)
+        self.f.write(data)
+        self.f.write(pack(">I", crc32(data, crc32(kind))))
+
+    # rows is a rgb cv2 image of the next rows
+    def write(self, rows) -> None:
+        rows = rows.reshape(rows.shape[0], -1)
+        up = rows - concatenate((self.prev, rows[:-1]))
+        self.prev = rows[-1:].copy()
+        data = self.z.compress(concatenate((full((len(rows), 1), 2, uint8), up), 1).tobytes()) + self.z.flush(Z_SYNC_FLUSH)
+        self.chunk(b"IDAT", data)
+        self.f.flush()
+
+    def close(self) -> None:
+        self.chunk(b"IDAT", self.z.flush())
+        self.chunk(b"IEND", b"")
+        self.f.flush()
+
+# riff chunks of a still webp as (fourcc, data) pairs
+def _chunks(data: bytes) -> list:
+    res, i = [], 12
+    while i + 8 <= len(data):
+        kind, n = data[i:i + 4], unpack_from("<I", data, i + 4)[0]
+        res.append((kind, data[i + 8:i + 8 + n]))
+        i += 8 + n + (n & 1)
+    return res
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return kind + pack("<I", len(data)) + data + b"\0" * (len(data) & 1)
+
+# WebpAnimStream writes an animated webp to the seekable file f frame by frame, only the
+# last frame is held (encoded) so that repeating it just extends its duration.
+# Every frame is a full canvas webp still, the riff size is patched in by close().
+class WebpAnimStream(object):
+    def __init__(self, f, width: int, height: int, loop: int = 0, quality: int = None, effort: int = None):
+        self.f = f
+        self.params = params("webp", quality, effort)
+        self.last = None# [encoded frame chunks, duration]
+        f.write(b"RIFF\0\0\0\0WEBP")
+        f.write(_chunk(b"VP8X", pack("<B3x", 0x02) + (width - 1).to_bytes(3, "little") + (height - 1).to_bytes(3, "little")))
+        f.write(_chunk(b"ANIM", pack("<IH", 0, loop)))
+        self.width, self.height = width, height
+
+    def flush(self) -> None:
+        if self.last == None: return
+        data, ms = self.last
+        # x and y offset 0, size, duration, no blending with the previous canvas
+        head = b"\0" * 6 + (self.width - 1).to_bytes(3, "little") + (self.height - 1).to_bytes(3, "little") + min(ms, 0xFFFFFF).to_bytes(3, "little") + b"\x02"
+        self.f.write(_chunk(b"ANMF", head + data))
+        self.last = None
+
+    # frame is a bgr cv2 image shown for duration ms
+    def write(self, frame, duration: int) -> None:
+        self.flush()
+        ok, data = imencode(".webp", frame, self.params)
+        self.last = [b"".join(_chunk(k, d) for k, d in _chunks(data.tobytes()) if k != b"VP8X"), int(duration)]
+
+    # shows the last frame duration ms longer
+    def extend(self, duration: int) -> None:
+        self.last[1] += int(duration)
+
+    def close(self) -> None:
+        self.flush()
+        size = self.f.tell()
+        self.f.seek(4)
+        self.f.write(pack("<I", size - 8))
+        self.f.seek(size)
+        self.f.flush()
+
+# VideoStream writes a vp9 webm to path at a constant fps, frames are repeated or dropped
+# so that every frame starts at its timestamp. ffmpeg picks the container by the file
+# extension, so the file is written as path.webm and moved to path by close().
+class VideoStream(object):
+    def __init__(self, path: str, width: int, height: int, fps: float = 25):
+        self.path = path
+        self.out = VideoWriter(path + ".webm", VideoWriter_fourcc(*"VP90"), fps, (width, height))
+        if not self.out.isOpened(): raise RuntimeError("vp9 video encoder not available")
+        self.fps = fps
+        self.ms = 0.0# time written so far
+        self.last = None
+
+    def write(self, frame, duration: int) -> None:
+        self.last = frame
+        self.extend(duration)
+
+    def extend(self, duration: int) -> None:
+        n = round((self.ms + duration) * self.fps / 1000) - round(self.ms * self.fps / 1000)
+        self.ms += duration
+        for _ in range(n): self.out.write(self.last)
+
+    def close(self) -> None:
+        self.out.release()
+        replace(self.path + ".webm", self.path)
+
+# encode time and output size of every format for a 4x sized image
+# usage: python encoder.py [image] [scale]
+if __name__ == "__main__":
+    from sys import argv
+    from time import time
+    from cv2 import imread, resize, INTER_CUBIC, IMREAD_COLOR
+    img = imread(argv[1] if len(argv) > 1 else "input_dir1/in.png", IMREAD_COLOR)
+    s = int(argv[2]) if len(argv) > 2 else 4
+    img = resize(img, (img.shape[1] * s, img.shape[0] * s), interpolation=INTER_CUBIC)
+    print(f"{img.shape[1]}x{img.shape[0]}")
+    settings = {"webp": [(None, None), (75, None), (90, None)],
+                "avif": [(None, None), (60, 2), (60, 5), (80, 5)],
+                "jpeg": [(None, None), (85, 0), (85, 9), (95, 9)],
+                "png": [(None, None), (None, 1), (None, 9)]}
+    for fmt in FORMATS:
+        for quality, effort in settings[fmt]:
+            t = time()
+            data = encode(img, fmt, quality, effort)
+            t = time() - t
+            print(f"{fmt:5} quality={str(quality):4} effort={str(effort):4} {t * 1000:8.1f}ms {len(data) / 1024:9.1f}KB")
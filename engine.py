@@ -0,0 +1,114 @@
+from hashlib import md5
+from os import makedirs, stat, replace, getpid
+from os.path import join, exists
+from weights import weight_file
+from torch import nn
+import torch
+
+# traced wrappers, every stage of UpCunet becomes its own graph since states differ per stage
+class _Full(nn.Module):
+    def __init__(self, net):
+        super(_Full, self).__init__()
+        self.net = net
+
+    def forward(self, x):
+        return self.net.full(x)
+
+class _Stage(nn.Module):
+    def __init__(self, net, k):
+        super(_Stage, self).__init__()
+        self.net = net
+        self.k = k
+
+    def forward(self, *args):
+        if self.k == 0: return self.net.stage(0, args[0], None)
+        state, t = self.net.stage(self.k, tuple(args[:-1]), args[-1])
+        return state if self.k == 4 else (state, t) # traced graphs cannot return None
+
+def _trace(m: nn.Module, example: tuple):
+    with torch.no_grad():
+        return torch.jit.trace(m.eval(), example, check_trace=False)
+
+# Engine holds the compiled graphs of one UpCunet, set it as net.engine to use them.
+# Graphs do not depend on the input size, any tile size and batch size can be used.
+# The traced graphs are what gets cached, freezing folds the weights into constants and
+# optimize_for_inference fuses conv with the following activation where the CPU backend supports it,
+# both are cheap but their result cannot be saved and loaded again.
+class Engine(object):
+    NAMES = ["full", "s0", "s1", "s2", "s3", "s4"]
+
+    def __init__(self, traced: dict):
+        self.traced = traced
+        self.graphs = {n: torch.jit.optimize_for_inference(torch.jit.freeze(g.eval())) for n, g in traced.items()}
+
+    @classmethod
+    def build(cls, net):
+        net.engine = None
+        p = net.pad
+        x = torch.rand(1, 3, 64 + 2 * p, 64 + 2 * p)
+        graphs = {"full": _trace(_Full(net), (x,))}
+        state, mean = x, None
+        with torch.no_grad():
+            for k in range(5):
+                example = (state,) if k == 0 else (*state, mean)
+                graphs["s%d" % k] = _trace(_Stage(net, k), example)
+                if k < 4:
+                    state, t = net.stage(k, state, mean)
+                    mean = net.tile_mean(t)
+        return cls(graphs)
+
+    # compiled graphs are cached in cache_dir keyed by the weight file (the .pth or its mapped
+    # .safetensors), its mtime and the torch version
+    @classmethod
+    def load(cls, net, weight_path: str, cache_dir: str):
+        st = stat(weight_file(weight_path))
+        key = md5(f"{weight_path}_{st.st_mtime}_{st.st_size}_{torch.__version__}_{net.scale}".encode()).hexdigest()
+        d = join(cache_dir, key)
+        if all(exists(join(d, n + ".pt")) for n in cls.NAMES):
+            return cls({n: torch.jit.load(join(d, n + ".pt"), map_location="cpu") for n in cls.NAMES})
+        engine = cls.build(net)
+        makedirs(d, 0o755, exist_ok=True)
+        for n, g in engine.traced.items():
+            tmp = join(d, f"{n}.{getpid()}.tmp")
+            torch.jit.save(g, tmp)
+            replace(tmp, join(d, n + ".pt"))
+        return engine
+
+    def full(self, x):
+        return self.graphs["full"](x)
+
+    def stage(self, k, state, se_mean):
+        if k == 0: state, t = self.graphs["s0"](state)
+        elif k == 4: return self.graphs["s4"](*state, se_mean), None
+        else: state, t = self.graphs["s%d" % k](*state, se_mean)
+        return tuple(state), t
+
+# benchmark against eager mode on CPU and check that both give the same output
+# usage: python engine.py [scale] [size] [tile] [weight_path], random weights without weight_path
+if __name__ == "__main__":
+    from sys import argv, exit
+    from time import time
+    from upcunet_v3 import UpCunet2x, UpCunet3x, UpCunet4x
+    scale = int(argv[1]) if len(argv) > 1 else 2
+    size = int(argv[2]) if len(argv) > 2 else 256
+    tile = int(argv[3]) if len(argv) > 3 else 2
+    net = {2: UpCunet2x, 3: UpCunet3x, 4: UpCunet4x}[scale]().eval()
+    if len(argv) > 4: net.load_state_dict(torch.load(argv[4], map_location="cpu"), strict=True)
+    t = time()
+    engine = Engine.build(net)
+    print(f"compile {time() - t:.2f}s")
+    x = torch.rand(1, 3, size, size)
+    res = {}
+    with torch.no_grad():
+        for name, e in (("eager", None), ("jit", engine)):
+            net.engine = e
+            net(x, tile) # warm up
+            times = []
+            for _ in range(3):
+                t = time()
+                res[name] = net(x, tile)
+                times.append(time() - t)
+            print(f"{name}: {min(times):.3f}s per {size}x{size} image, {scale}x tile={tile}")
+    diff = (res["eager"] - res["jit"]).abs().max().item()
+    print(f"max abs diff {diff:.2e}")
+    if diff > 1e-4: exit(1)
@@ -0,0 +1,123 @@
+from gevent import get_hub
+from urllib3 import PoolManager, Timeout, Retry
+from urllib3.exceptions import HTTPError
+from cache import MemoryCache
+from time import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# leading bytes of the formats cv2.imdecode reads
+MAGIC = [b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"BM", b"II*\x00", b"MM\x00*"]
+
+def is_image(head: bytes) -> bool:
+    return any(head.startswith(m) for m in MAGIC) or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+
+# mp4/mov, webm/mkv and avi, the videos animation.py reads
+def is_video(head: bytes) -> bool:
+    return head[4:8] == b"ftyp" or head.startswith(b"\x1a\x45\xdf\xa3") or (head[:4] == b"RIFF" and head[8:12] == b"AVI ")
+
+# scheme and host are lowercased, default ports, empty paths and fragments dropped and
+# query parameters sorted, so spellings of the same url share cache entries. Only used
+# as a cache key, urls are downloaded as given.
+def normalize(url: str) -> str:
+    try: u = urlsplit(url.strip())
+    except ValueError: return url.strip()# e.g. a bad ipv6 host, fails when downloaded
+    scheme, host = u.scheme.lower(), (u.hostname or "").lower()
+    if ":" in host: host = f"[{host}]"
+    try: port = u.port
+    except ValueError: port = None
+    if port != None and (scheme, port) not in [("http", 80), ("https", 443)]: host += f":{port}"
+    if u.username != None: host = u.netloc.rsplit("@", 1)[0] + "@" + host
+    return urlunsplit((scheme, host, u.path or "/", urlencode(sorted(parse_qsl(u.query, keep_blank_values=True))), ""))
+
+# FetchError carries the http status the server should answer with
+class FetchError(Exception):
+    def __init__(self, status: int, message: str):
+        super(FetchError, self).__init__(message)
+        self.status = status
+
+# Fetcher downloads images for GET /scale?url= through one long lived PoolManager
+# that keeps a keep-alive pool per host. Bodies are streamed and dropped as soon as
+# they exceed max_bytes or do not look like an image.
+# Downloads are kept ttl seconds by url, after that they are revalidated with
+# If-None-Match / If-Modified-Since so unchanged images are not downloaded again.
+# The etag and last modified date live in the cache entry and are evicted with the data.
+class Fetcher(object):
+    def __init__(self, connect: float, read: float, max_bytes: int, ttl: float, cache_bytes: int, hosts: int = 16, conns: int = 4):
+        # redirects are followed (up to 5), failed connects and reads are not retried
+        self.pool = PoolManager(num_pools=hosts, maxsize=conns, timeout=Timeout(connect=connect, read=read), retries=Retry(total=None, connect=0, read=0, other=0, redirect=5))
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.data = MemoryCache(cache_bytes, min(max_bytes, cache_bytes))# url -> data, fetched_at, (etag, last_modified)
+        self.stats = {"fetches": 0, "hits": 0, "revalidated": 0, "rejected": 0, "bytes": 0}
+
+    # with video videos are accepted besides images
+    def get(self, url: str, video: bool = False) -> bytes:
+        key = normalize(url)
+        v = self.data.entry(key)
+        if v != None and time() - v[1] < self.ttl:
+            self.stats["hits"] += 1
+            return v[0]
+        res = self.fetch(url, None if v == None else v[2], video)
+        if res == None:# not modified
+            v = self.data.entry(key)
+            if v != None:
+                self.stats["revalidated"] += 1
+                self.data.put(key, v[0], meta=v[2])
+                return v[0]
+            res = self.fetch(url, None, video)# evicted meanwhile
+        data, etag, modified = res
+        self.stats["fetches"] += 1
+        self.stats["bytes"] += len(data)
+        if self.ttl > 0 or etag or modified: self.data.put(key, data, meta=(etag, modified))
+        return data
+
+    # urllib3 blocks on sockets, a native thread lets other greenlets run meanwhile. The
+    # cache and stats are only touched here in the hub thread, errors are returned rather
+    # than raised in the native thread so the threadpool does not log them.
+    def fetch(self, url: str, meta: tuple = None, video: bool = False) -> tuple:
+        res = get_hub().threadpool.apply(self._download, (url, meta, video))
+        if isinstance(res, FetchError):
+            if res.status in (413, 415): self.stats["rejected"] += 1
+            raise res
+        return res
+
+    def _download(self, url: str, meta: tuple = None, video: bool = False):
+        try: return self.download(url, meta, video)
+        except FetchError as e: return e
+
+    # (data, etag, last_modified), None when meta is given and upstream answers not modified
+    def download(self, url: str, meta: tuple = None, video: bool = False) -> tuple:
+        accept = (lambda head: is_image(head) or is_video(head)) if video else is_image
+        headers = {}
+        if meta != None and meta[0]: headers["If-None-Match"] = meta[0]
+        if meta != None and meta[1]: headers["If-Modified-Since"] = meta[1]
+        try: r = self.pool.request("GET", url, headers=headers, preload_content=False)
+        except (HTTPError, ValueError) as e: raise FetchError(502, f"fetch failed: {e}")
+        try:
+            if r.status == 304 and meta != None: return None
+            if r.status != 200: raise FetchError(502, f"fetch failed: upstream status {r.status}")
+            ctype = r.headers.get("Content-Type", "")
+            if ctype and not ctype.startswith(("image/", "application/octet-stream", *(("video/",) if video else ()))): self.reject(415, f"not an image: {ctype}")
+            if int(r.headers.get("Content-Length") or 0) > self.max_bytes: self.reject(413, "image too large")
+            chunks, size = [], 0
+            for chunk in r.stream(64 << 10):
+                if not chunks and len(chunk) >= 12 and not accept(chunk): self.reject(415, "not an image")
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > self.max_bytes: self.reject(413, "image too large")
+            data = b"".join(chunks)
+            del chunks
+            if not accept(data[:12]): self.reject(415, "not an image")
+        except BaseException as e:
+            r.close()# a partly read body must not go back to the pool
+            if isinstance(e, HTTPError): raise FetchError(502, f"fetch failed: {e}")
+            raise
+        finally: r.release_conn()
+        return data, r.headers.get("ETag"), r.headers.get("Last-Modified")
+
+    # counted as rejected by fetch
+    def reject(self, status: int, message: str) -> None:
+        raise FetchError(status, message)
+
+    def info(self) -> dict:
+        return {**self.stats, "cached": len(self.data.items), "cached_bytes": self.data.size, "hosts": len(self.pool.pools)}
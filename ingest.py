@@ -0,0 +1,131 @@
+from cv2 import imdecode, cvtColor, resize, IMREAD_COLOR, IMREAD_IGNORE_ORIENTATION, IMREAD_REDUCED_COLOR_2, IMREAD_REDUCED_COLOR_4, IMREAD_REDUCED_COLOR_8, COLOR_BGR2RGB, INTER_AREA
+from numpy import frombuffer, uint8, ndarray
+from struct import unpack_from
+from math import sqrt
+
+REDUCED = {2: IMREAD_REDUCED_COLOR_2, 4: IMREAD_REDUCED_COLOR_4, 8: IMREAD_REDUCED_COLOR_8}
+
+# ImageError carries the http status the server should answer with
+class ImageError(Exception):
+    def __init__(self, status: int, message: str):
+        super(ImageError, self).__init__(message)
+        self.status = status
+
+def _jpeg(data) -> tuple:
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF: return None
+        marker = data[i + 1]
+        if marker == 0xFF:# fill byte
+            i += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        # SOF0-15 except DHT, JPG and DAC carry the frame size
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h, w = unpack_from(">HH", data, i + 5)
+            return w, h
+        i += 2 + unpack_from(">H", data, i + 2)[0]
+    return None
+
+# (width, height) from the header of png, jpeg, webp, gif or bmp data without decoding it,
+# None for other formats or truncated headers
+def probe(data) -> tuple:
+    try:
+        head = bytes(data[:30])
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR": return unpack_from(">II", head, 16)
+        if head.startswith(b"GIF8"): return unpack_from("<HH", head, 6)
+        if head.startswith(b"BM"):
+            w, h = unpack_from("<ii", head, 18)
+            return w, abs(h)
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            kind = head[12:16]
+            if kind == b"VP8 ":
+                w, h = unpack_from("<HH", head, 26)
+                return w & 0x3FFF, h & 0x3FFF
+            if kind == b"VP8L":
+                b = unpack_from("<I", head, 21)[0]
+                return (b & 0x3FFF) + 1, ((b >> 14) & 0x3FFF) + 1
+            if kind == b"VP8X":
+                return int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+            return None
+        if head.startswith(b"\xff\xd8"): return _jpeg(data)
+    except Exception: return None# struct.error on truncated data
+    return None
+
+# largest size of the same aspect ratio within max_pixels, (w, h) when it already fits
+def fit(w: int, h: int, max_pixels: int) -> tuple:
+    if max_pixels <= 0 or w * h <= max_pixels: return w, h
+    f = sqrt(max_pixels / (w * h))
+    return max(int(w * f), 1), max(int(h * f), 1)
+
+# data is encoded image data, result is a rgb cv2 image or None.
+# The buffer is decoded without copying it first and the channels are swapped in place,
+# grayscale, alpha and 16 bit images are converted to 8 bit bgr by imdecode itself.
+# With size (w, h) smaller than the image it is decoded at 1/2, 1/4 or 1/8 when that is
+# still at least size (jpeg skips the work, other formats are reduced after decoding)
+# and then resized to size.
+def decode(data, size: tuple = None, full: tuple = None) -> ndarray:
+    flags = IMREAD_COLOR
+    if size != None and full != None:
+        r = max([r for r in REDUCED if full[0] // r >= size[0] and full[1] // r >= size[1]], default=0)
+        if r: flags = REDUCED[r]
+    frame = imdecode(frombuffer(data, uint8), flags | IMREAD_IGNORE_ORIENTATION)
+    if frame is None: return None
+    if size != None: frame = downsize(frame, size)
+    return cvtColor(frame, COLOR_BGR2RGB, dst=frame)
+
+# frame resized to size (w, h), unchanged when it already has that size
+def downsize(frame: ndarray, size: tuple) -> ndarray:
+    if (frame.shape[1], frame.shape[0]) == tuple(size): return frame
+    return resize(frame, tuple(size), interpolation=INTER_AREA)
+
+# compares allocations and time of the old and the new request path for one image
+# usage: python ingest.py [width] [height]
+if __name__ == "__main__":
+    from sys import argv
+    from time import time
+    from hashlib import md5
+    from cv2 import imencode, IMREAD_UNCHANGED
+    from torch.profiler import profile, ProfilerActivity
+    from cache import digest
+    import tracemalloc
+    import numpy as np
+    import torch
+
+    w = int(argv[1]) if len(argv) > 1 else 1920
+    h = int(argv[2]) if len(argv) > 2 else 1080
+    img = (np.random.rand(h, w, 3) * 255).astype(uint8)
+    data = imencode(".png", img)[1].tobytes()
+    suffix = b"weights_v3/up2x-latest-no-denoise.pth_2"
+
+    def old():
+        m = md5(data + suffix).hexdigest()
+        frame = imdecode(frombuffer(data, uint8), IMREAD_UNCHANGED)[:, :, [2, 1, 0]]
+        return m, torch.from_numpy(np.transpose(frame, (2, 0, 1))).unsqueeze(0).float() / 255
+
+    def new():
+        m = digest(data, suffix)
+        frame = decode(data)
+        tensor = torch.empty((1, 3, h, w), dtype=torch.float32)
+        tensor[0].copy_(torch.from_numpy(frame).permute(2, 0, 1))
+        return m, tensor.div_(255)
+
+    assert torch.equal(old()[1], new()[1])
+    print(f"{w}x{h}, {len(data) / 2**20:.1f}MB png")
+    for name, fn in [("old", old), ("new", new)]:
+        fn()
+        tracemalloc.start()
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof: fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        allocated = sum(e.self_cpu_memory_usage for e in prof.key_averages() if e.self_cpu_memory_usage > 0)
+        t = time()
+        for _ in range(10): fn()
+        t = (time() - t) / 10
+        print(f"{name}: {t * 1000:.1f}ms, numpy peak {peak / 2**20:.1f}MB, torch allocated {allocated / 2**20:.1f}MB")
+    for name, fn in [("md5(data+suffix)", lambda: md5(data + suffix).hexdigest()), ("digest(data, suffix)", lambda: digest(data, suffix))]:
+        t = time()
+        for _ in range(20): fn()
+        print(f"{name}: {(time() - t) / 20 * 1000:.2f}ms")
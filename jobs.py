@@ -0,0 +1,100 @@
+from gevent import spawn
+from gevent.queue import Queue
+from json import load, dump
+from os import makedirs, replace, remove, scandir
+from os.path import join, exists
+from uuid import uuid4
+from time import time
+
+# JobStore persists asynchronous jobs in root: <id>.json holds the job, <id>.in its input
+# until the job finished and <id>.progress the progress written by the worker running it.
+# Jobs still queued or running when the server stopped are queued again on boot, in the
+# order they were submitted. Finished jobs are forgotten keep seconds after they finished.
+class JobStore(object):
+    def __init__(self, root: str, keep: float):
+        self.root = root
+        self.keep = keep
+        self.jobs = {}
+        self.queue = Queue()
+        self.runners = []
+        self.stats = {"submitted": 0, "done": 0, "failed": 0, "recovered": 0}
+        makedirs(root, 0o755, exist_ok=True)
+        self.warm()
+
+    def path(self, id: str, ext: str) -> str:
+        return join(self.root, f"{id}.{ext}")
+
+    def warm(self) -> None:
+        found = []
+        with scandir(self.root) as it:
+            for e in it:
+                if not e.name.endswith(".json"): continue
+                try:
+                    with open(e.path) as f: found.append(load(f))
+                except (OSError, ValueError): remove(e.path)# written partly
+        for job in sorted(found, key=lambda job: job["created"]):
+            self.jobs[job["id"]] = job
+            if job["status"] in ("queued", "running"):
+                self.save(job, status="queued")
+                self.queue.put(job["id"])
+                self.stats["recovered"] += 1
+
+    def save(self, job: dict, **fields) -> None:
+        job.update(fields)
+        tmp = self.path(job["id"], "json.tmp")
+        with open(tmp, "w") as f: dump(job, f)
+        replace(tmp, self.path(job["id"], "json"))
+
+    # args are the request parameters, data the input image or None when args has a url
+    def submit(self, args: dict, data: bytes = None) -> dict:
+        self.expire()
+        job = {"id": uuid4().hex, "status": "queued", "created": time(), "args": args}
+        if data != None:
+            with open(self.path(job["id"], "in"), "wb") as f: f.write(data)
+        self.save(job)
+        self.jobs[job["id"]] = job
+        self.queue.put(job["id"])
+        self.stats["submitted"] += 1
+        return job
+
+    def get(self, id: str) -> dict:
+        return self.jobs.get(id)
+
+    def input(self, job: dict) -> bytes:
+        p = self.path(job["id"], "in")
+        if not exists(p): return None
+        with open(p, "rb") as f: return f.read()
+
+    # phase and tiles done of a running job, empty before the first tile finished
+    def progress(self, job: dict) -> dict:
+        try:
+            with open(self.path(job["id"], "progress")) as f: return load(f)
+        except (OSError, ValueError): return {}
+
+    def finish(self, job: dict, **fields) -> None:
+        self.save(job, finished=time(), **fields)
+        self.stats[job["status"]] += 1
+        for ext in ("in", "progress"):
+            if exists(self.path(job["id"], ext)): remove(self.path(job["id"], ext))
+
+    def expire(self) -> None:
+        now = time()
+        for id in [id for id, job in self.jobs.items() if job.get("finished", now) + self.keep < now]:
+            del self.jobs[id]
+            remove(self.path(id, "json"))
+
+    # runners greenlets take jobs in order and call run(job), which returns the fields of
+    # the finished job and sets status to done or failed
+    def start(self, run, runners: int) -> None:
+        if self.runners: return
+        self.runners = [spawn(self._loop, run) for _ in range(runners)]
+
+    def _loop(self, run) -> None:
+        while True:
+            job = self.jobs.get(self.queue.get())
+            if job == None: continue
+            self.save(job, status="running", started=time())
+            self.finish(job, **run(job))
+
+    def info(self) -> dict:
+        return {**self.stats, "queued": self.queue.qsize(), "running": sum(job["status"] == "running" for job in self.jobs.values()), "jobs": len(self.jobs)}
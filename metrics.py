@@ -0,0 +1,93 @@
+from contextlib import contextmanager
+from resource import getrusage, RUSAGE_SELF
+from time import time
+
+# Prometheus text format without the client library, metrics of this process only.
+# Values of worker processes (model stages, peak rss) are sent back with every job
+# and observed here by the server.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RSS_BUCKETS = tuple(float(1 << i) for i in range(26, 36))# 64MB - 32GB
+
+def _labels(labels: dict) -> str:
+    if not labels: return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels.items()) + "}"
+
+class Counter(object):
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, n: float = 1, **labels) -> None:
+        k = tuple(sorted(labels.items()))
+        self.values[k] = self.values.get(k, 0) + n
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"] + \
+               [f"{self.name}{_labels(dict(k))} {v}" for k, v in self.values.items()]
+
+class Histogram(object):
+    def __init__(self, name: str, help: str, buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}# labels -> [count per bucket..., sum, count]
+
+    def observe(self, v: float, **labels) -> None:
+        k = tuple(sorted(labels.items()))
+        h = self.values.get(k)
+        if h == None: h = self.values[k] = [0] * (len(self.buckets) + 2)
+        for i, b in enumerate(self.buckets):
+            if v <= b: h[i] += 1
+        h[-2] += v
+        h[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for k, h in self.values.items():
+            for b, n in zip(self.buckets, h):
+                lines.append(f"{self.name}_bucket{_labels({**dict(k), 'le': b})} {n}")
+            lines.append(f"{self.name}_bucket{_labels({**dict(k), 'le': '+Inf'})} {h[-1]}")
+            lines.append(f"{self.name}_sum{_labels(dict(k))} {h[-2]}")
+            lines.append(f"{self.name}_count{_labels(dict(k))} {h[-1]}")
+        return lines
+
+# values read from the stats dicts of the other modules at scrape time
+def gauge(name: str, help: str, values: list, kind: str = "gauge") -> list:
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}"] + [f"{name}{_labels(labels)} {v}" for labels, v in values]
+
+REQUESTS = Counter("cugan_requests_total", "http requests by endpoint and status")
+LATENCY = Histogram("cugan_request_seconds", "http request latency by endpoint")
+STAGES = Histogram("cugan_stage_seconds", "time spent per request stage: fetch, decode, infer, np2tensor, full or se_phase0-4, tensor2np, encode, cache_write, animate")
+PEAK_RSS = Histogram("cugan_job_peak_rss_bytes", "peak resident memory of the process running an inference job", RSS_BUCKETS)
+
+@contextmanager
+def stage(name: str):
+    t = time()
+    try: yield
+    finally: STAGES.observe(time() - t, stage=name)
+
+# spans are (stage, seconds) pairs recorded by a worker during one job
+def observe_job(spans: list, peak_rss: int) -> None:
+    for name, sec in spans: STAGES.observe(sec, stage=name)
+    if peak_rss: PEAK_RSS.observe(peak_rss)
+
+# the high water mark of the resident memory is reset before a job (linux only),
+# so that VmHWM afterwards is the peak of that job
+def reset_peak_rss() -> None:
+    try:
+        with open("/proc/self/clear_refs", "w") as f: f.write("5")
+    except OSError: pass
+
+def peak_rss() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"): return int(line.split()[1]) * 1024
+    except OSError: pass
+    return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+def render(extra: list = []) -> str:
+    return "\n".join(REQUESTS.render() + LATENCY.render() + STAGES.render() + PEAK_RSS.render() + extra) + "\n"
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from glob import glob
+from re import search
+from time import time
+from upcunet_v3 import RealWaifuUpScaler
+from engine import Engine
+from quant import apply_precision
+from weights import mapped_path, weight_path_of, load_weights, uses_mapped
+
+# scale is encoded in the weight file name, e.g. weights_v3/up2x-latest-no-denoise.pth
+def weight_scale(weight_path: str) -> int:
+    return int(search(r"up(\d)x", weight_path).group(1))
+
+# paths is a comma separated list of weight files or globs, e.g. "weights_v3/up2x-*.pth".
+# Mapped .safetensors files match by their .pth name, so either may be deployed.
+def _glob(p: str) -> list:
+    found = {w for w in glob(p) if not w.endswith(".safetensors")} | {weight_path_of(w) for w in glob(mapped_path(p))}
+    return sorted(found)
+
+def expand(paths: str) -> list:
+    return [w for p in paths.split(",") if p.strip() for w in _glob(p.strip())]
+
+# load state dicts so that forked workers use the same pages: mapped files are shared
+# through the page cache, torch.load results are moved into shared memory
+def load_shared(paths: str, mapped: bool = True) -> dict:
+    weights = {}
+    for weight_path in expand(paths):
+        use = uses_mapped(weight_path, mapped)
+        weight = load_weights(weight_path, use)
+        if not use:
+            for t in weight.values(): t.share_memory_()
+        weights[weight_path] = weight
+    return weights
+
+# ModelPool keeps at most max_models loaded upscalers keyed by weight path only,
+# tile_mode is a forward-time argument so every tile mode shares the same model.
+# The least recently used model is dropped when the pool is full.
+# weights maps weight paths to preloaded state dicts which are used instead of torch.load,
+# with mapped other models are loaded from their mapped .safetensors file when there is one,
+# without it only when there is no .pth.
+# engine "jit" runs the traced and frozen graphs of engine.py, cached in engine_dir.
+# precision "bf16" or "int8" is applied by quant.py, jit is only used at fp32.
+class ModelPool(object):
+    def __init__(self, max_models: int, half: bool = False, device: str = "cpu:0", weights: dict = {}, engine: str = "eager", engine_dir: str = "engines", precision: str = "fp32", mapped: bool = True):
+        self.max_models = max_models
+        self.mapped = mapped
+        self.weights = weights
+        self.engine = engine
+        self.engine_dir = engine_dir
+        self.precision = precision
+        self.half = half
+        self.device = device
+        self.models = OrderedDict()
+        self.stats = {"loads": 0, "hits": 0, "evictions": 0, "load_sec": 0.0}
+
+    def get(self, weight_path: str) -> RealWaifuUpScaler:
+        m = self.models.get(weight_path)
+        if m != None:
+            self.stats["hits"] += 1
+            self.models.move_to_end(weight_path)
+            return m
+        while len(self.models) >= max(self.max_models, 1):
+            self.models.popitem(last=False)
+            self.stats["evictions"] += 1
+        t = time()
+        weight = self.weights.get(weight_path)
+        if weight == None and uses_mapped(weight_path, self.mapped): weight = load_weights(weight_path)
+        m = self.models[weight_path] = RealWaifuUpScaler(weight_scale(weight_path), weight_path, half=self.half, device=self.device, weight=weight)
+        if self.precision != "fp32" and not self.half: apply_precision(m, weight_path, self.precision)
+        elif self.engine == "jit" and not self.half: m.model.engine = Engine.load(m.model, weight_path, self.engine_dir)
+        self.stats["loads"] += 1
+        self.stats["load_sec"] += time() - t
+        return m
+
+    def preload(self, paths: str) -> None:
+        for weight_path in expand(paths): self.get(weight_path)
+
+    def info(self) -> dict:
+        return {**self.stats, "resident": list(self.models), "shared": list(self.weights)}
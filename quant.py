@@ -0,0 +1,117 @@
+from glob import glob
+from os import replace, getpid
+from os.path import exists, getmtime
+from torch import nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
+from upcunet_v3 import SEBlock
+from weights import weight_file
+import numpy as np
+import torch
+import cv2
+
+PRECISIONS = ["fp32", "bf16", "int8"]
+# images used to calibrate the int8 activation ranges when no calibration file exists
+CALIB_IMAGES = "input_dir1/*"
+
+def bf16_supported() -> bool:
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+# a float conv surrounded by quantize/dequantize, after convert the conv runs in int8
+# and the activations around it (pads, adds, SE, transposed convs) stay fp32
+class QuantConv(nn.Module):
+    def __init__(self, conv):
+        super(QuantConv, self).__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+# wrap every spatial Conv2d, the 1x1 convs of SEBlocks work on 1x1 means and are left as they are
+def _wrap(m: nn.Module, qconfig) -> None:
+    for name, child in list(m.named_children()):
+        if isinstance(child, SEBlock): continue
+        if isinstance(child, nn.Conv2d) and child.kernel_size != (1, 1):
+            q = QuantConv(child)
+            q.qconfig = qconfig
+            setattr(m, name, q)
+        else: _wrap(child, qconfig)
+
+def _frames(pattern: str, size: int = 128) -> list:
+    frames = []
+    for path in sorted(glob(pattern)):
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None: continue
+        h, w = img.shape[:2]
+        f = size / max(h, w)
+        if f < 1: img = cv2.resize(img, (max(int(w * f), 8), max(int(h * f), 8)), interpolation=cv2.INTER_AREA)
+        frames.append(img[:, :, ::-1].copy())
+    return frames
+
+# static int8 quantization of the convs of net in place, activation ranges come from running
+# the calibration frames through the fp32 net, or from a saved state of an earlier calibration
+def quantize_int8(net: nn.Module, frames: list = [], state: dict = None) -> nn.Module:
+    torch.backends.quantized.engine = "x86" if "x86" in torch.backends.quantized.supported_engines else "fbgemm"
+    _wrap(net, get_default_qconfig(torch.backends.quantized.engine))
+    prepare(net, inplace=True)
+    if state is None:
+        with torch.no_grad():
+            for frame in frames:
+                net(torch.from_numpy(np.transpose(frame, (2, 0, 1))).unsqueeze(0).float() / 255, 0)
+    convert(net, inplace=True)
+    if state is not None: net.load_state_dict(state)
+    return net
+
+# apply precision to a loaded RealWaifuUpScaler, int8 calibration is cached next to the weight file
+# and redone when the weight file is newer than it
+def apply_precision(m, weight_path: str, precision: str) -> None:
+    if precision == "bf16":
+        if bf16_supported(): m.autocast = torch.bfloat16
+        else: print("bf16 is not supported by this CPU, using fp32")
+    elif precision == "int8":
+        calib = weight_path + ".int8"
+        if exists(calib) and getmtime(calib) >= getmtime(weight_file(weight_path)): quantize_int8(m.model, state=torch.load(calib, map_location="cpu"))
+        else:
+            quantize_int8(m.model, frames=_frames(CALIB_IMAGES))
+            tmp = f"{calib}.{getpid()}.tmp"
+            torch.save(m.model.state_dict(), tmp)
+            replace(tmp, calib)
+
+def psnr(a: np.ndarray, b: np.ndarray) -> float:
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+def ssim(a: np.ndarray, b: np.ndarray) -> float:
+    a, b = a.astype(np.float64), b.astype(np.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    blur = lambda x: cv2.GaussianBlur(x, (11, 11), 1.5)
+    ma, mb = blur(a), blur(b)
+    va, vb, cov = blur(a * a) - ma * ma, blur(b * b) - mb * mb, blur(a * b) - ma * mb
+    return float(np.mean((2 * ma * mb + c1) * (2 * cov + c2) / ((ma * ma + mb * mb + c1) * (va + vb + c2))))
+
+# calibrate int8 for a weight file on sample images and compare every precision against fp32
+# usage: python quant.py <weight_path> [image glob] [tile]
+if __name__ == "__main__":
+    from sys import argv
+    from time import time
+    from models import weight_scale
+    from upcunet_v3 import RealWaifuUpScaler
+    weight_path = argv[1]
+    pattern = argv[2] if len(argv) > 2 else CALIB_IMAGES
+    tile = int(argv[3]) if len(argv) > 3 else 0
+    frames = _frames(pattern, 256)
+    m = RealWaifuUpScaler(weight_scale(weight_path), weight_path, half=False, device="cpu")
+    quantize_int8(m.model, frames=frames)
+    torch.save(m.model.state_dict(), weight_path + ".int8")
+    print("saved", weight_path + ".int8")
+    outputs = {}
+    for precision in PRECISIONS:
+        if precision == "bf16" and not bf16_supported(): continue
+        m = RealWaifuUpScaler(weight_scale(weight_path), weight_path, half=False, device="cpu")
+        apply_precision(m, weight_path, precision)
+        t = time()
+        outputs[precision] = [m(f, tile) for f in frames]
+        t = time() - t
+        scores = [(psnr(a, b), ssim(a, b)) for a, b in zip(outputs["fp32"], outputs[precision])]
+        print(f"{precision}: {t:.2f}s, PSNR {min(s[0] for s in scores):.2f}dB SSIM {min(s[1] for s in scores):.4f} (worst image vs fp32)")
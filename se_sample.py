@@ -0,0 +1,47 @@
+from argparse import ArgumentParser
+from glob import glob
+from time import time
+from cv2 import imread, IMREAD_COLOR, COLOR_BGR2RGB, cvtColor
+from upcunet_v3 import RealWaifuUpScaler
+from quant import psnr
+from metrics import reset_peak_rss, peak_rss
+
+# Compares the exact tiled forward (4 SE phases over all tiles) with se_sample, which
+# estimates the SE means from a share of the tiles and runs the rest in one pass, and with
+# lowmem, the exact mode of about the same memory. Prints time, peak rss and psnr to exact.
+# usage: python se_sample.py [--images "input_dir1/*"] [--scales 2,4] [--tiles 2,4] [--samples 0.5,0.25,0.125]
+
+def _list(conv):
+    return lambda s: [conv(v) for v in s.split(",") if v]
+
+def frame_of(path: str):
+    return cvtColor(imread(path, IMREAD_COLOR), COLOR_BGR2RGB)
+
+def run(m, frame, tile, **opts) -> tuple:
+    reset_peak_rss()
+    t = time()
+    out = m(frame, tile, **opts)
+    return out, time() - t, peak_rss()
+
+if __name__ == "__main__":
+    p = ArgumentParser(description="speed and psnr of se_sample against the exact tiled mode")
+    p.add_argument("--images", default="input_dir1/*")
+    p.add_argument("--scales", type=_list(int), default=[2, 4])
+    p.add_argument("--tiles", type=_list(int), default=[2, 4])
+    p.add_argument("--samples", type=_list(float), default=[0.5, 0.25, 0.125])
+    p.add_argument("--model", default="no-denoise")
+    a = p.parse_args()
+    for scale in a.scales:
+        m = RealWaifuUpScaler(scale, f"weights_v3/up{scale}x-latest-{a.model}.pth", half=False, device="cpu")
+        m(frame_of(sorted(glob(a.images))[0])[:64, :64], 2)# warm up
+        for path in sorted(glob(a.images)):
+            frame = frame_of(path)
+            for tile in a.tiles:
+                exact, t0, rss0 = run(m, frame, tile)
+                print(f"{path} {frame.shape[1]}x{frame.shape[0]} scale={scale} tile={tile}", flush=True)
+                print(f"  exact          {t0:7.2f}s {rss0 / 2**20:7.0f}MB", flush=True)
+                _, t, rss = run(m, frame, tile, lowmem=True)
+                print(f"  lowmem         {t:7.2f}s {rss / 2**20:7.0f}MB  x{t0 / t:.2f}", flush=True)
+                for s in a.samples:
+                    out, t, rss = run(m, frame, tile, se_sample=s)
+                    print(f"  se_sample={s:<5} {t:7.2f}s {rss / 2**20:7.0f}MB  x{t0 / t:.2f}  psnr {psnr(exact, out):.1f}dB", flush=True)
@@ -1,103 +1,487 @@
-from numpy import frombuffer, uint8
-from upcunet_v3 import RealWaifuUpScaler
-from cv2 import imencode, imdecode, IMREAD_UNCHANGED
-from flask import Flask, request
-from gevent import pywsgi
+from workers import WorkerPool
+from tiling import choose_tile, max_tile_batch, estimate_memory, estimate_cost
+from admission import Admission, Overloaded
+from batcher import Batcher
+from singleflight import SingleFlight
+from jobs import JobStore
+from cache import ResultCache, UrlIndex, digest
+from ingest import decode, downsize, probe, fit, ImageError
+from fetch import Fetcher, FetchError, normalize
+from weights import weight_exists
+from config import BATCH_WINDOW, BATCH_MAX, CACHE_DIR, CACHE_DISK_BYTES, CACHE_MEM_BYTES, CACHE_MEM_ITEM, CACHE_TTL, MODEL_MAX, MODEL_PRELOAD, MMAP_WEIGHTS, WORKERS, WORKER_THREADS, TILE_BUDGET, TILE_WORKERS, TILE_BATCH, ENGINE, ENGINE_DIR, PRECISION, FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT, FETCH_MAX_BYTES, FETCH_CACHE_TTL, FETCH_CACHE_BYTES, URL_CACHE_TTL, URL_CACHE_ITEMS, ENCODE_THREADS, ADMIT_BUDGET, ADMIT_QUEUE, ADMIT_WAIT, MAX_PIXELS, OVERSIZE, MAX_DECODE_PIXELS, MAX_FRAMES, ANIM_BATCH, JOBS_DIR, JOBS_KEEP, JOBS_RUNNERS, JOBS_RETRIES, BATCH_ITEMS, BATCH_PARALLEL, SE_SAMPLE
+from encoder import FORMATS, MIMETYPES, encode
+from animation import FORMATS as ANIM_FORMATS, animation, info as anim_info
+from metrics import REQUESTS, LATENCY, stage, gauge, render as render_metrics
+from flask import Flask, Response, request, send_file, g
+from gevent import pywsgi, spawn, sleep
+from gevent.pool import Pool
+from gevent.queue import Queue
+from gevent.threadpool import ThreadPool
 from urllib.request import unquote
 from sys import argv
-from urllib3 import PoolManager
-from time import time
-from hashlib import md5
-from os import mkdir
+from http import HTTPStatus
+from os import remove
 from os.path import exists
+from uuid import uuid4
+from json import loads
+from time import time
 
 app = Flask(__name__)
-pool = PoolManager()
-ups = {}
+fetcher = Fetcher(FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT, FETCH_MAX_BYTES, FETCH_CACHE_TTL, FETCH_CACHE_BYTES)
+workers = WorkerPool(WORKERS, WORKER_THREADS, MODEL_PRELOAD, max_models=MODEL_MAX, engine=ENGINE, engine_dir=ENGINE_DIR, precision=PRECISION, mapped=MMAP_WEIGHTS == 1)
 
 def get_arg(key: str) -> str:
     return request.args.get(key)
 
-last_req_time = 0
-def clear_pool() -> None:
-    global pool, last_req_time
-    if time() - last_req_time > 60:
-        pool.clear()
-        last_req_time = time()
+batcher = Batcher(workers.run, BATCH_WINDOW, BATCH_MAX)
+admission = Admission(ADMIT_BUDGET, ADMIT_QUEUE, ADMIT_WAIT)
 
 # frame, result is all cv2 image
-def calc(model: str, scale: int, tile: int, frame):
-    m = f"{model}_{tile}"
-    if m in ups: m = ups[m]
-    else:
-        ups[m] = RealWaifuUpScaler(scale, model, half=False, device="cpu:0")
-        m = ups[m]
-    img = m(frame, tile_mode=tile)[:, :, ::-1]
+# opts are extra keyword arguments of RealWaifuUpScaler, e.g. lowmem
+# with progress the frame is not batched and its progress is written into that file
+def calc(model: str, scale: int, tile: int, frame, opts: dict = {}, progress: str = None):
+    key = (model, scale, tile, frame.shape, tuple(sorted(opts.items())))
+    with stage("infer"): img = (batcher.submit(key, frame) if progress == None else workers.run(key, [frame], progress)[0])[:, :, ::-1]
     del frame
     return img
 
+# size (w, h) an input of w x h pixels is upscaled at, raises ImageError when it is too large
+def limit(w: int, h: int) -> tuple:
+    if w <= 0 or h <= 0: raise ImageError(400, "bad image size")
+    top = MAX_PIXELS if OVERSIZE != "downsize" else MAX_DECODE_PIXELS
+    if w * h > top: raise ImageError(413, f"image of {w}x{h} pixels is larger than {top} pixels")
+    return fit(w, h, MAX_PIXELS)
+
+# data is image data, full is its size from the header or None, result is rgb cv2 image of size
+def load(data: bytes, size: tuple = None, full: tuple = None):
+    with stage("decode"): frame = decode(data, size, full)
+    if frame is None: raise ImageError(400, "can not decode image")
+    return frame
+
+# data is image data, result is tile, input size (w, h), size to upscale at, opts and the
+# frame if it had to be decoded already. The size is probed from the header, so limits,
+# tile "auto", tile_batch and admission are decided before the full decode, which then
+# allocates only the (reduced) size. Formats without a known header are decoded first.
+def prepare(scale: int, tile, data: bytes, opts: dict = {}) -> tuple:
+    full, frame = probe(data), None
+    if full == None:
+        frame = load(data)
+        full = frame.shape[1], frame.shape[0]
+    size = limit(*full)
+    if frame is not None: frame = downsize(frame, size)
+    tile, opts = schedule(scale, tile, size, opts)
+    return tile, full, size, opts, frame
+
+# resolves tile "auto" and tile_batch for n frames of size (w, h) run together
+def schedule(scale: int, tile, size: tuple, opts: dict, n: int = 1) -> tuple:
+    w, h = size
+    budget = min(TILE_BUDGET, admission.budget)# a job must fit into the admission budget too
+    if tile == "auto":
+        tile, lowmem = choose_tile(scale, h, w, budget, opts.get("lowmem", False), n, opts.get("se_sample", 0))
+        opts = {**opts, "lowmem": lowmem}
+    return tile, {**opts, "tile_batch": max_tile_batch(scale, h, w, tile, opts.get("lowmem", False), budget, TILE_BATCH, n, opts.get("se_sample", 0))}
+
+# estimated peak memory and compute of a job of n frames run together, jobs wait for memory and cheaper ones go first
+def job_cost(scale: int, size: tuple, tile, opts: dict, n: int = 1) -> tuple:
+    w, h = size
+    return estimate_memory(scale, h, w, tile, opts["lowmem"], n, opts["tile_batch"], opts.get("se_sample", 0)), estimate_cost(scale, h, w, tile, opts["lowmem"]) * n
+
 # data is image data, result is cv2 image
-# data will be deleted
-def calcdata(model: str, scale: int, tile: int, data: bytes):
-    umat = frombuffer(data, uint8)
+# data will be deleted, raises Overloaded when the job is not admitted and ImageError for bad inputs
+def calcdata(model: str, scale: int, tile, data: bytes, opts: dict = {}, progress: str = None):
+    tile, full, size, opts, frame = prepare(scale, tile, data, opts)
+    with admission.slot(*job_cost(scale, size, tile, opts)):
+        if frame is None: frame = load(data, size, full)
+        del data
+        return calc(model, scale, tile, frame, opts, progress)
+
+flight = SingleFlight()
+cache = ResultCache(CACHE_DIR, CACHE_DISK_BYTES, CACHE_MEM_BYTES, CACHE_MEM_ITEM, CACHE_TTL)
+urls = UrlIndex(URL_CACHE_TTL, URL_CACHE_ITEMS)
+
+encoders = ThreadPool(ENCODE_THREADS)
+
+# m is the cache key, fmt is (format, quality, effort), result is encoded data.
+# cv2 releases the gil while encoding, so the encoder threads run in parallel with the
+# http loop and the workers, which already compute the next batch meanwhile.
+def render(m: str, model: str, scale: int, tile, data: bytes, opts: dict = {}, fmt: tuple = ("webp", None, None), progress: str = None) -> bytes:
+    frame = calcdata(model, scale, tile, data, opts, progress)
+    with stage("encode"): data = encoders.apply(encode, (frame, *fmt))
+    del frame
+    if len(data):
+        with stage("cache_write"): cache.put(m, data)
+    return data
+
+# the output is computed as a png into a temp file of the disk cache, bands are sent
+# while the worker appends them and the finished file becomes the cached result
+def streamed(m: str, model: str, scale: int, tile, data: bytes, opts: dict = {}, effort: int = None) -> Response:
+    tile, full, size, opts, frame = prepare(scale, tile, data, opts)
+    memory, priority = job_cost(scale, size, tile, opts)
+    admission.acquire(memory, priority)
+    t0 = time()
+    tmp = f = None
+    # until the job owns the reservation every failure gives it back
+    try:
+        if frame is None: frame = load(data, size, full)
+        tmp = cache.disk.temp(m, f".{uuid4().hex}")
+        open(tmp, "wb").close()
+        f = open(tmp, "rb")# stays readable when the file is moved into the cache or removed
+        job = spawn(workers.stream, (model, scale, tile, frame.shape, tuple(sorted(opts.items()))), frame, tmp, effort)
+    except BaseException:
+        admission.release(memory, 0)
+        if f != None: f.close()
+        if tmp != None and exists(tmp): remove(tmp)
+        raise
     del data
-    frame = imdecode(umat, IMREAD_UNCHANGED)[:, :, [2, 1, 0]]
-    del umat
-    return calc(model, scale, tile, frame)
+    job.link(lambda job: admission.release(memory, time() - t0))
+    job.link(lambda job: cache.adopt(m, tmp) if job.successful() else remove(tmp))
+    del frame
+    def tail():
+        with f:
+            while True:
+                done = job.ready()
+                chunk = f.read(1 << 16)
+                if chunk: yield chunk
+                elif done: break
+                else: sleep(0.02)
+    return Response(tail(), mimetype="image/png", headers={"Vary": "Accept"})
+
+anim_stats = {"jobs": 0, "frames": 0, "upscaled": 0, "skipped": 0}
+
+# anim is the result of animation(data), fmt is (format, quality, effort) with format webp or webm.
+# The worker decodes, upscales and encodes the frames into a temp file of the disk cache,
+# result is the cached output (a path when it is on disk only).
+def animate(m: str, model: str, scale: int, tile, data: bytes, anim: tuple, opts: dict, fmt: tuple, progress: str = None):
+    kind, count = anim
+    w, h, frames, _, _ = anim_info(data, kind, count)
+    if not w or not h: raise ImageError(400, "can not decode video")
+    if frames > MAX_FRAMES: raise ImageError(413, f"animation of {frames} frames is longer than {MAX_FRAMES} frames")
+    size = limit(w, h)
+    n = min(ANIM_BATCH, max(frames, 1))
+    tile, opts = schedule(scale, tile, size, opts, n)
+    memory, priority = job_cost(scale, size, tile, opts, n)
+    with admission.slot(memory, priority * max(frames // n, 1)):
+        tmp = cache.disk.temp(m, f".{uuid4().hex}")
+        try:
+            with stage("animate"): res = workers.animate((model, scale, tile, (size[1], size[0], 3), tuple(sorted(opts.items()))), data, kind, size, tmp, fmt, n, MAX_FRAMES, progress)
+        except BaseException:
+            for p in (tmp, tmp + ".webm"):# the webm encoder writes next to tmp
+                if exists(p): remove(p)
+            raise
+    anim_stats["jobs"] += 1
+    for k, v in res.items(): anim_stats[k] += v
+    cache.adopt(m, tmp)
+    return cache.get(m) or b""
 
 MODEL_LIST = ["conservative", "no-denoise", "denoise1x", "denoise2x", "denoise3x"]
 
-@app.route("/scale", methods=['GET', 'POST'])
-def scale():
-    model = get_arg("model")
-    scale = get_arg("scale")
-    tile = get_arg("tile")
-    print(model, scale, tile)
+# response of an error carrying its http status
+def error(e: Exception) -> tuple:
+    return f"{e.status} {HTTPStatus(e.status).phrase.upper()}: {e}", e.status, {"Retry-After": str(e.retry_after)} if getattr(e, "retry_after", 0) else {}
+
+# parameters of /scale, /jobs and /scale/batch items, result is a dict or an error response.
+# get(key) returns a parameter as str or None, the query string by default
+def parse_args(get=get_arg):
+    model = get("model")
+    scale = get("scale")
+    tile = get("tile")
+    lowmem = get("lowmem")
+    fmt = get("format")
+    quality = get("quality")
+    effort = get("effort")
+    stream = get("stream") == "1"
+    fast = get("fast") == "1"
 
     if model == None: model = "no-denoise"
     if scale == None: scale = "2"
     if tile == None: tile = "2"
+    if not scale.isdecimal(): return "400 BAD REQUEST: no such scale", 400
+    if tile != "auto" and not tile.isdecimal(): return "400 BAD REQUEST: no such tile", 400
     scale = int(scale)
-    tile = int(tile)
+    if tile != "auto": tile = int(tile)
+    # lowmem and tile_workers give the same output, so they are not part of the cache key, tile_batch is set after decoding
+    opts = {"lowmem": lowmem == "1", "tile_workers": TILE_WORKERS}
+    if fast: opts["se_sample"] = SE_SAMPLE
 
     if model not in MODEL_LIST: return "400 BAD REQUEST: no such model", 400
     if scale not in [2, 3, 4]: return "400 BAD REQUEST: no such scale", 400
-    if tile not in range(9): return "400 BAD REQUEST: no such tile", 400
+    if tile != "auto" and tile not in range(9): return "400 BAD REQUEST: no such tile", 400
+    # without format the Accept header decides, webp if it allows anything, streams are png
+    if stream: fmt = "png"
+    if fmt == None: fmt = MIMETYPES[request.accept_mimetypes.best_match(MIMETYPES, "image/webp")]
+    if fmt not in FORMATS and fmt not in ANIM_FORMATS: return "400 BAD REQUEST: no such format", 400
+    if quality != None and (not quality.isdecimal() or int(quality) not in range(1, 101)): return "400 BAD REQUEST: no such quality", 400
+    if effort != None and (not effort.isdecimal() or int(effort) not in range(10)): return "400 BAD REQUEST: no such effort", 400
+    fmt = (fmt, None if quality == None else int(quality), None if effort == None else int(effort))
 
     model = f"weights_v3/up{scale}x-latest-{model}.pth"
-    if not exists(model): return "400 BAD REQUEST: no such model", 400
+    if not weight_exists(model): return "400 BAD REQUEST: no such model", 400
+    # default webp outputs keep the cache keys they had before formats existed
+    suffix = f"{model}_{tile}" if fmt == ("webp", None, None) else f"{model}_{tile}_{fmt[0]}_{fmt[1]}_{fmt[2]}"
+    if stream: suffix += "_stream"
+    if fast: suffix += f"_se{SE_SAMPLE}"
+    return {"model": model, "scale": scale, "tile": tile, "opts": opts, "fmt": fmt, "stream": stream, "suffix": suffix}
+
+# whether the output of a can be an animation, the input may then be an animation or a video
+def animates(a: dict) -> bool:
+    return a["fmt"][0] in ("webp", *ANIM_FORMATS) and not a["stream"]
+
+# a are the parsed parameters, data the input, result is the cache key of the output and the animation of data.
+# Animations are upscaled whole into animated webp or webm, other formats take the first frame.
+def result_key(a: dict, data: bytes) -> tuple:
+    anim = animation(data) if animates(a) else None
+    if anim == None and a["fmt"][0] in ANIM_FORMATS: raise ImageError(400, f"{a['fmt'][0]} needs an animation or video")
+    return digest(data, (a["suffix"] + ("_anim" if anim else "")).encode()), anim
+
+# computes the output of data into the cache, result is the output (a path when it is on disk only)
+def compute(m: str, a: dict, data: bytes, anim: tuple, progress: str = None):
+    if anim: return flight.do(m, animate, m, a["model"], a["scale"], a["tile"], data, anim, a["opts"], a["fmt"], progress)
+    return flight.do(m, render, m, a["model"], a["scale"], a["tile"], data, a["opts"], a["fmt"], progress)
 
+# data is the output or the path of it
+def respond(data, mimetype: str):
+    if isinstance(data, str):
+        r = send_file(open(data, "rb"), mimetype=mimetype, conditional=False, etag=False)
+        r.headers["Vary"] = "Accept"
+        return r
+    if not len(data): return "500 Internal Server Error: zero output data len", 500
+    return data, 200, {"Content-Type": mimetype, "Content-Length": len(data), "Vary": "Accept"}
+
+def mimetype_of(fmt) -> str:
+    return {**FORMATS, **ANIM_FORMATS}[fmt[0]][1]
+
+# key of url in the url index, url itself is downloaded unchanged
+def url_key(url: str, suffix: str) -> str:
+    return f"{normalize(url)} {suffix}"
+
+# ?url= is decoded once more only when it was encoded twice, escapes of signed urls stay as sent
+def url_arg(url: str) -> str:
+    return url if "://" in url else unquote(url)
+
+# a are the parsed parameters, data the input or None to download url.
+# result is the output (a path when it is on disk only), a png Response when streaming
+def produce(a: dict, data: bytes = None, url: str = None):
+    suffix = a["suffix"]
+    hit = None
+    if data == None:
+        # a url seen recently is served from the cache without downloading it again
+        m = urls.get(url_key(url, suffix))
+        hit = cache.get(m) if m != None else None
+        if hit != None: return hit
+        with stage("fetch"): data = fetcher.get(url, animates(a))
+    if not len(data): raise ImageError(400, "zero data len")
+    m, anim = result_key(a, data)
+    if url != None: urls.put(url_key(url, suffix), m)
+    hit = cache.get(m)
+    if hit != None: return hit
+    if a["stream"]: return streamed(m, a["model"], a["scale"], a["tile"], data, a["opts"], a["fmt"][2])
+    return compute(m, a, data, anim)
+
+@app.route("/scale", methods=['GET', 'POST'])
+def scale():
+    a = parse_args()
+    if isinstance(a, tuple): return a
+    url, data = None, None
     if request.method == 'GET':
         url = get_arg("url")
         if url == None: return "400 BAD REQUEST: no url", 400
-        url = unquote(url)
-        global pool
-        clear_pool()
-        r = pool.request('GET', url)
-        data = r.data
-        r.release_conn()
-        del r
+        url = url_arg(url)
+    else: data = request.get_data(as_text=False)
+    try: data = produce(a, data, url)
+    except (FetchError, Overloaded, ImageError) as e: return error(e)
+    if isinstance(data, Response): return data
+    return respond(data, mimetype_of(a["fmt"]))
+
+# items of /scale/batch as (parameters or error response, data, url), error response if the body is invalid.
+# A multipart body has one file part per item and an optional items field, a json list of
+# per-item parameters in the same order. A json body is {"items": [{"url": ..., "scale": 4, ...}]}.
+# The query string holds the defaults of every item.
+def batch_items():
+    if request.files:
+        files = [f for _, f in request.files.items(multi=True)]
+        try: params = loads(request.form.get("items", "[]"))
+        except ValueError: params = None
+        if not isinstance(params, list): return "400 BAD REQUEST: items is no json list", 400
+        params += [{}] * (len(files) - len(params))
+        items = [(p, f.read(), None) for p, f in zip(params, files)]
     else:
-        data = request.get_data(as_text=False)
-    if not len(data): return "400 BAD REQUEST: zero data len", 400
-    m = "tmp/"+md5(data+f"{model}_{tile}".encode()).hexdigest()
-    if exists(m):
-        with open(m, "rb") as f: data = f.read()
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get("items"), list): return "400 BAD REQUEST: no items", 400
+        items = [(p, None, p.get("url") if isinstance(p, dict) else None) for p in body["items"]]
+    if not items: return "400 BAD REQUEST: no items", 400
+    if len(items) > BATCH_ITEMS: return f"413 REQUEST ENTITY TOO LARGE: more than {BATCH_ITEMS} items", 413
+    res = []
+    # a bad item fails only its own part
+    for p, data, url in items:
+        if not isinstance(p, dict): a = "400 BAD REQUEST: items must be objects", 400
+        elif url != None and not isinstance(url, str): a = "400 BAD REQUEST: url must be a string", 400
+        else: a = parse_args(lambda k: str(p[k]) if p.get(k) != None else get_arg(k))
+        if not isinstance(a, tuple) and a["stream"]: a = "400 BAD REQUEST: items can not stream", 400
+        if data == None and url == None and not isinstance(a, tuple): a = "400 BAD REQUEST: no url", 400
+        res.append((a, data, None if isinstance(a, tuple) else url))
+    return res
+
+def batch_part(boundary: str, i: int, status: int, mimetype: str, data) -> bytes:
+    return f"--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Length: {len(data)}\r\nX-Index: {i}\r\nX-Status: {status}\r\n\r\n".encode() + data + b"\r\n"
+
+# many images in one request, same parameters as /scale per item. Every item is looked up
+# in the cache first and hits are sent at once, misses run together (at most BATCH_PARALLEL
+# at a time) so same-shape frames of a model are batched. Results are streamed as
+# multipart/mixed in the order they finish, X-Index is the position of the item and
+# X-Status its http status, failed items are text/plain.
+@app.route("/scale/batch", methods=['POST'])
+def scale_batch():
+    items = batch_items()
+    if isinstance(items, tuple): return items
+    boundary = uuid4().hex
+    done = Queue()
+    def emit(i, a, out):
+        if isinstance(out, str):
+            with open(out, "rb") as f: out = f.read()
+        done.put((i, 200, mimetype_of(a["fmt"]), out) if len(out) else (i, 500, "text/plain", b"500 Internal Server Error: zero output data len"))
+    def run(i, a, fn):
+        try: emit(i, a, fn())
+        except (FetchError, Overloaded, ImageError) as e: done.put((i, e.status, "text/plain", error(e)[0].encode()))
+        except Exception as e: done.put((i, 500, "text/plain", f"500 INTERNAL SERVER ERROR: {e!r}".encode()))
+    misses = []
+    for i, (a, data, url) in enumerate(items):
+        if isinstance(a, tuple):
+            done.put((i, a[1], "text/plain", a[0].encode()))
+            continue
+        if data != None:
+            try: m, anim = result_key(a, data) if len(data) else (None, None)
+            except ImageError as e:
+                done.put((i, e.status, "text/plain", error(e)[0].encode()))
+                continue
+            hit = cache.get(m) if m != None else None
+            fn = (lambda a=a, data=data, m=m, anim=anim: compute(m, a, data, anim)) if m != None else (lambda a=a, data=data: produce(a, data))
+        else:
+            m = urls.get(url_key(url, a["suffix"]))
+            hit = cache.get(m) if m != None else None
+            fn = lambda a=a, url=url: produce(a, None, url)
+        if hit != None: emit(i, a, hit)
+        else: misses.append((i, a, fn))
+    # same model, scale and tile next to each other, so their frames meet in the same batch window
+    pool = Pool(BATCH_PARALLEL)
+    for i, a, fn in sorted(misses, key=lambda it: (it[1]["model"], str(it[1]["tile"]))): pool.spawn(run, i, a, fn)
+    def parts():
+        for _ in items: yield batch_part(boundary, *done.get())
+        yield f"--{boundary}--\r\n".encode()
+    return Response(parts(), mimetype=f"multipart/mixed; boundary={boundary}")
+
+jobs = JobStore(JOBS_DIR, JOBS_KEEP)
+
+# runs a job of /jobs, waiting for admission instead of failing while the server is busy
+def run_job(job: dict) -> dict:
+    a = {**job["args"], "fmt": tuple(job["args"]["fmt"])}
+    try:
+        data = jobs.input(job)
+        if data == None:
+            with stage("fetch"): data = fetcher.get(a["url"], animates(a))
+        m, anim = result_key(a, data)
+        if a.get("url"): urls.put(url_key(a["url"], a["suffix"]), m)
+        # a busy server is retried up to JOBS_RETRIES times, the job is computed at most once
+        for retry in range(JOBS_RETRIES + 1):
+            if cache.get(m) != None: break
+            try:
+                compute(m, a, data, anim, jobs.path(job["id"], "progress"))
+                break
+            except Overloaded as e:
+                if e.status == 413 or retry == JOBS_RETRIES: raise
+                sleep(e.retry_after)
+        # e.g. larger than CACHE_DISK_BYTES or evicted at once
+        if cache.get(m) == None: return {"status": "failed", "error": "the result could not be stored", "code": 507}
+        return {"status": "done", "key": m}
+    except (FetchError, Overloaded, ImageError) as e: return {"status": "failed", "error": str(e), "code": e.status}
+    except Exception as e: return {"status": "failed", "error": repr(e), "code": 500}
+
+def job_info(job: dict) -> dict:
+    info = {k: job[k] for k in ["id", "status", "created", "started", "finished", "error", "code"] if k in job}
+    if job["status"] == "running": info["progress"] = jobs.progress(job)
+    if job["status"] == "done": info["result"] = f"/jobs/{job['id']}/result"
+    return info
+
+# same parameters as /scale, the image is the body or ?url=, answers 202 with the job id at once
+@app.route("/jobs", methods=['POST'])
+def submit_job():
+    a = parse_args()
+    if isinstance(a, tuple): return a
+    if a["stream"]: return "400 BAD REQUEST: jobs can not stream", 400
+    url = get_arg("url")
+    data = None
+    if url != None: a["url"] = url_arg(url)
     else:
-        _, data = imencode(".webp", calcdata(model, scale, tile, data))
-        data = data.tobytes()
-        if not len(data): return "500 Internal Server Error: zero output data len", 500
-        with open(m, "wb") as f: f.write(data)
-    return data, 200, {"Content-Type": "image/webp", "Content-Length": len(data)}
+        data = request.get_data(as_text=False)
+        if not len(data): return "400 BAD REQUEST: zero data len", 400
+    jobs.start(run_job, JOBS_RUNNERS)
+    job = jobs.submit(a, data)
+    return job_info(job), 202, {"Location": f"/jobs/{job['id']}"}
+
+@app.route("/jobs/<id>", methods=['GET'])
+def get_job(id: str):
+    job = jobs.get(id)
+    if job == None: return "404 NOT FOUND: no such job", 404
+    return job_info(job)
+
+@app.route("/jobs/<id>/result", methods=['GET'])
+def job_result(id: str):
+    job = jobs.get(id)
+    if job == None: return "404 NOT FOUND: no such job", 404
+    if job["status"] == "failed": return f"{job['code']} {HTTPStatus(job['code']).phrase.upper()}: {job['error']}", job["code"]
+    if job["status"] != "done": return f"409 CONFLICT: job is {job['status']}", 409
+    data = cache.get(job["key"])
+    if data == None: return "410 GONE: result was evicted from the cache", 410
+    return respond(data, mimetype_of(job["args"]["fmt"]))
+
+@app.route("/stats", methods=['GET'])
+def stats():
+    return {"batch": batcher.stats, "flight": flight.stats, "cache": cache.info(), "workers": workers.info(), "fetch": fetcher.info(), "urls": urls.info(), "admission": admission.info(), "animation": anim_stats, "jobs": jobs.info()}
+
+@app.before_request
+def start_timer():
+    g.t0 = time()
+
+@app.after_request
+def count_request(r):
+    endpoint = request.url_rule.rule if request.url_rule else "unknown"
+    REQUESTS.inc(endpoint=endpoint, status=r.status_code)
+    LATENCY.observe(time() - g.t0, endpoint=endpoint)
+    return r
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    c, w, models = cache.info(), workers.info(), workers.info()["models"]
+    extra = gauge("cugan_cache_lookups_total", "result cache lookups by outcome", [({"result": k}, c[k]) for k in ["mem_hits", "disk_hits", "misses"]], "counter") + \
+        gauge("cugan_cache_hit_ratio", "result cache hits / lookups", [({}, (c["mem_hits"] + c["disk_hits"]) / max(c["mem_hits"] + c["disk_hits"] + c["misses"], 1))]) + \
+        gauge("cugan_cache_bytes", "bytes held by the result cache", [({"tier": "mem"}, c["mem_bytes"]), ({"tier": "disk"}, c["disk_bytes"])]) + \
+        gauge("cugan_cache_items", "items held by the result cache", [({"tier": "mem"}, c["mem_items"]), ({"tier": "disk"}, c["disk_items"])]) + \
+        gauge("cugan_url_index_lookups_total", "url index lookups by outcome", [({"result": k}, v) for k, v in urls.stats.items()], "counter") + \
+        gauge("cugan_fetch_total", "url downloads by outcome", [({"result": k}, v) for k, v in fetcher.stats.items() if k != "bytes"], "counter") + \
+        gauge("cugan_fetch_bytes_total", "bytes downloaded", [({}, fetcher.stats["bytes"])], "counter") + \
+        gauge("cugan_queue_frames", "frames waiting to be batched", [({}, sum(len(q) for q in batcher.queues.values()))]) + \
+        gauge("cugan_workers_busy", "inference jobs running", [({}, w["busy"])]) + \
+        gauge("cugan_admission_waiting", "jobs waiting for memory", [({}, admission.waiting)]) + \
+        gauge("cugan_admission_memory_bytes", "estimated memory of running jobs and the budget", [({"kind": "used"}, admission.used), ({"kind": "budget"}, admission.budget)]) + \
+        gauge("cugan_admission_total", "admission decisions", [({"result": k}, admission.stats[k]) for k in ["admitted", "queued", "rejected", "timeouts"]], "counter") + \
+        gauge("cugan_async_jobs", "jobs of /jobs by state", [({"state": k}, v) for k, v in jobs.info().items() if k in ("queued", "running")]) + \
+        gauge("cugan_async_jobs_total", "jobs of /jobs by outcome", [({"result": k}, jobs.stats[k]) for k in ["submitted", "done", "failed", "recovered"]], "counter") + \
+        gauge("cugan_jobs_total", "inference jobs finished", [({}, w["jobs"])], "counter") + \
+        gauge("cugan_batch_frames_total", "frames run in batches", [({}, batcher.stats["frames"])], "counter") + \
+        gauge("cugan_flight_dups_total", "requests that waited for an identical running request", [({}, flight.stats["dups"])], "counter") + \
+        gauge("cugan_model_resident", "weights loaded per worker process", [({"worker": pid, "model": m}, 1) for pid, i in models.items() for m in i["resident"]]) + \
+        gauge("cugan_model_loads_total", "model loads per worker process", [({"worker": pid}, i["loads"]) for pid, i in models.items()], "counter") + \
+        gauge("cugan_model_evictions_total", "models dropped per worker process", [({"worker": pid}, i["evictions"]) for pid, i in models.items()], "counter")
+    return render_metrics(extra), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 def handle_client():
     global app
     host = argv[1]
     port = int(argv[2])
+    workers.start()
+    jobs.start(run_job, JOBS_RUNNERS)
     print("Starting SC at:", host, port)
     pywsgi.WSGIServer((host, port), app).serve_forever()
 
 if __name__ == "__main__":
-    if not exists("tmp"): mkdir("tmp", 0o755)
     if len(argv) == 3: handle_client()
     else: print("Usage: <host> <port>")
\ No newline at end of file
@@ -0,0 +1,32 @@
+from gevent.event import AsyncResult
+from time import time
+
+# SingleFlight runs fn only once for concurrent calls sharing the same key,
+# duplicates wait for and share the first call's result.
+class SingleFlight(object):
+    def __init__(self):
+        self.calls = {}
+        self.stats = {"calls": 0, "dups": 0, "dup_rate": 0.0, "wait_sec": 0.0, "max_wait_sec": 0.0}
+
+    def do(self, key, fn, *args):
+        st = self.stats
+        st["calls"] += 1
+        r = self.calls.get(key)
+        if r != None:
+            st["dups"] += 1
+            st["dup_rate"] = st["dups"] / st["calls"]
+            t = time()
+            try: return r.get()
+            finally:
+                t = time() - t
+                st["wait_sec"] += t
+                st["max_wait_sec"] = max(st["max_wait_sec"], t)
+        st["dup_rate"] = st["dups"] / st["calls"]
+        r = self.calls[key] = AsyncResult()
+        try: v = fn(*args)
+        except Exception as e:
+            r.set_exception(e)
+            raise
+        finally: del self.calls[key]
+        r.set(v)
+        return v
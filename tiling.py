@@ -0,0 +1,101 @@
+from math import ceil
+from upcunet_v3 import UpCunet2x, UpCunet3x, UpCunet4x
+
+NETS = {2: UpCunet2x, 3: UpCunet3x, 4: UpCunet4x}
+
+# peak bytes per padded input pixel, measured on CPU fp32 with python tiling.py
+# work: working set of one tile (or of the whole image when tile=0)
+# keep: intermediates kept per tile between the SE phases of the default tiled mode
+MEMORY = {
+    2: {"work": 6000, "keep": 1100},
+    3: {"work": 15000, "keep": 2300},
+    4: {"work": 7000, "keep": 2200},
+}
+# per tile overhead in padded pixels, more tiles cost more time than their pixels alone
+TILE_OVERHEAD = 64 * 64
+# lowmem recomputes earlier stages in every SE phase
+LOWMEM_COST = 3
+
+# estimated peak bytes of one forward pass over n frames of h0 x w0
+# tile is 0-8 or an explicit (crop_h, crop_w), tile_batch tiles share one working set,
+# with se_sample only the sampled tiles keep their intermediates
+def estimate_memory(scale: int, h0: int, w0: int, tile, lowmem: bool = False, n: int = 1, tile_batch: int = 1, se_sample: float = 0) -> int:
+    net, m = NETS[scale], MEMORY[scale]
+    p, a = net.pad, net.align
+    if tile == 0:
+        return n * m["work"] * (ceil(h0 / a) * a + 2 * p) * (ceil(w0 / a) * a + 2 * p)
+    ch, cw = net.crop_size(h0, w0, tile)
+    tiles = ceil(h0 / ch) * ceil(w0 / cw)
+    px = (ch + 2 * p) * (cw + 2 * p)
+    work = m["work"] * px * max(min(tile_batch, tiles), 1)
+    res = 4 * 3 * h0 * w0 * scale * scale
+    if lowmem: return n * (work + res)
+    kept = min(max(ceil(tiles * se_sample), tile_batch), tiles) if 0 < se_sample < 1 else tiles
+    return n * (m["keep"] * px * kept + work + res)
+
+# the largest tile_batch up to limit whose estimated peak memory fits budget bytes
+def max_tile_batch(scale: int, h0: int, w0: int, tile, lowmem: bool, budget: int, limit: int, n: int = 1, se_sample: float = 0) -> int:
+    if tile == 0: return 1
+    b = 1
+    while b < limit and estimate_memory(scale, h0, w0, tile, lowmem, n, b + 1, se_sample) <= budget: b += 1
+    return b
+
+# estimated relative compute cost, in padded pixels
+def estimate_cost(scale: int, h0: int, w0: int, tile, lowmem: bool = False) -> int:
+    net = NETS[scale]
+    p, a = net.pad, net.align
+    if tile == 0: return (ceil(h0 / a) * a + 2 * p) * (ceil(w0 / a) * a + 2 * p)
+    ch, cw = net.crop_size(h0, w0, tile)
+    cost = ceil(h0 / ch) * ceil(w0 / cw) * ((ch + 2 * p) * (cw + 2 * p) + TILE_OVERHEAD)
+    return cost * LOWMEM_COST if lowmem else cost
+
+# split h0 x w0 into th x tw crops whose sides are divisible by align
+def _crops(scale: int, h0: int, w0: int, min_crop: int = 32):
+    a = NETS[scale].align
+    seen = set()
+    for th in range(1, max(h0 // min_crop, 1) + 1):
+        for tw in range(1, max(w0 // min_crop, 1) + 1):
+            crop = (ceil(ceil(h0 / th) / a) * a, ceil(ceil(w0 / tw) / a) * a)
+            if crop not in seen:
+                seen.add(crop)
+                yield crop
+
+# pick the cheapest tile setting whose estimated peak memory fits budget bytes,
+# result is (tile, lowmem) where tile is 0 or a (crop_h, crop_w)
+# if nothing fits the smallest lowmem setting is returned
+def choose_tile(scale: int, h0: int, w0: int, budget: int, lowmem: bool = False, n: int = 1, se_sample: float = 0) -> tuple:
+    best, best_cost = None, None
+    options = [(0, False)] if not lowmem else []
+    options += [(c, lm) for c in _crops(scale, h0, w0) for lm in ((True,) if lowmem else (False, True))]
+    for tile, lm in options:
+        if estimate_memory(scale, h0, w0, tile, lm, n, 1, se_sample) > budget: continue
+        cost = estimate_cost(scale, h0, w0, tile, lm)
+        if best_cost == None or cost < best_cost: best, best_cost = (tile, lm), cost
+    if best == None:
+        best = min(((c, True) for c in _crops(scale, h0, w0)), key=lambda t: estimate_memory(scale, h0, w0, t[0], True, n))
+    return best
+
+# measure one forward pass in a fresh process, result is (peak bytes, seconds)
+def _measure(scale: int, size: int, tile, lowmem: bool) -> tuple:
+    import torch
+    from resource import getrusage, RUSAGE_SELF
+    from time import time
+    torch.set_num_threads(1)
+    m = NETS[scale]().eval()
+    with torch.no_grad():
+        m(torch.rand(1, 3, 40, 40), 0)
+        r0 = getrusage(RUSAGE_SELF).ru_maxrss
+        t = time()
+        m(torch.rand(1, 3, size, size), tile, lowmem)
+    return (getrusage(RUSAGE_SELF).ru_maxrss - r0) * 1024, time() - t
+
+# prints measured peak memory next to the estimate, used to update MEMORY
+if __name__ == "__main__":
+    from multiprocessing import get_context
+    ctx = get_context("fork")
+    for scale in NETS:
+        for size in (96, 192, 288):
+            for tile, lowmem in [(0, False), (2, False), (2, True), (4, False), (4, True)]:
+                with ctx.Pool(1) as pool: mem, t = pool.apply(_measure, (scale, size, tile, lowmem))
+                est = estimate_memory(scale, size, size, tile, lowmem)
+                print(f"{scale}x {size}px tile={tile} lowmem={lowmem}: {mem >> 20}MB (estimate {est >> 20}MB) {t:.2f}s")
@@ -3,6 +3,10 @@ from torch import nn as nn
 from torch.nn import functional as F
 import os,sys
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from itertools import count
+from copy import deepcopy
 root_path=os.path.abspath('.')
 sys.path.append(root_path)
 class SEBlock(nn.Module):
@@ -253,483 +257,320 @@ class UNet2(nn.Module):
         z = self.conv_bottom(x5)
         del x5
         return z
-class UpCunet2x(nn.Module):#完美tile，全程无损
-    def __init__(self, in_channels=3, out_channels=3):
-        super(UpCunet2x, self).__init__()
-        self.unet1 = UNet1(in_channels, out_channels, deconv=True)
-        self.unet2 = UNet2(in_channels, out_channels, deconv=False)
+class UpCunet(nn.Module):#完美tile，全程无损
+    # subclasses set scale, pad (reflect padding around the input) and align (input must be divisible by it)
+    scale=2
+    pad=18
+    align=2
 
-    def forward(self, x,tile_mode):#1.7G
-        n, c, h0, w0 = x.shape
-        if(tile_mode==0):#不tile
-            ph = ((h0 - 1) // 2 + 1) * 2
-            pw = ((w0 - 1) // 2 + 1) * 2
-            x = F.pad(x, (18, 18 + pw - w0, 18, 18 + ph - h0), 'reflect')  # 需要保证被2整除
-            x = self.unet1.forward(x)
-            x0 = self.unet2.forward(x)
-            x1 = F.pad(x, (-20, -20, -20, -20))
-            del x
-            x = torch.add(x0, x1)
-            del x0, x1
-            if (w0 != pw or h0 != ph): x = x[:, :, :h0 * 2, :w0 * 2]
-            return x
-        elif(tile_mode==1):# 对长边减半
+    def tail(self, x):#unet1+unet2的输出 -> 最终输出
+        return x
+
+    def skip(self, res, x00):
+        return res
+
+    # tile_mode is 1-8 or an explicit (crop_h, crop_w) whose sides are divisible by align
+    @classmethod
+    def crop_size(cls, h0, w0, tile_mode):
+        a = cls.align
+        if isinstance(tile_mode, tuple): return tile_mode
+        if(tile_mode==1):# 对长边减半
             if(w0>=h0):
-                crop_size_w=((w0-1)//4*4+4)//2#减半后能被2整除，所以要先被4整除
-                crop_size_h=(h0-1)//2*2+2#能被2整除
+                crop_size_w=((w0-1)//(a*2)*(a*2)+a*2)//2#减半后能被a整除，所以要先被2a整除
+                crop_size_h=(h0-1)//a*a+a#能被a整除
             else:
-                crop_size_h=((h0-1)//4*4+4)//2#减半后能被2整除，所以要先被4整除
-                crop_size_w=(w0-1)//2*2+2#能被2整除
-            crop_size=(crop_size_h,crop_size_w)#6.6G
+                crop_size_h=((h0-1)//(a*2)*(a*2)+a*2)//2
+                crop_size_w=(w0-1)//a*a+a
+            return (crop_size_h,crop_size_w)#6.6G
             #hw都减半 5.6G
             #hw都三分之一 4.2G
             #hw都四分之一 3.7G
-        else:
-            s = tile_mode*2
-            crop_size=(((h0-1)//s*s+s)//tile_mode,((w0-1)//s*s+s)//tile_mode)
+        s = tile_mode*2
+        return (((h0-1)//s*s+s)//tile_mode,((w0-1)//s*s+s)//tile_mode)
+
+    # a compiled engine (see engine.py) replaces full and stage when set
+    engine=None
+    # timer(stage, seconds) is called after the untiled pass and after every SE phase when set
+    timer=None
+    # progress(phase, done, total) is called after the untiled pass and after every group of tiles when set
+    progress=None
+
+    def lap(self, stage, t0):
+        if self.timer is not None: self.timer(stage, time()-t0)
+        return time()
+
+    def report(self, phase, done, total):
+        if self.progress is not None: self.progress(phase, done, total)
+
+    def full(self, x):#不tile
+        if self.engine is not None: return self.engine.full(x)
+        x = self.unet1.forward(x)
+        x0 = self.unet2.forward(x)
+        x1 = F.pad(x, (-20, -20, -20, -20))
+        del x
+        x = torch.add(x0, x1)
+        del x0, x1
+        return self.tail(x)
+
+    # the tiled forward is split into 5 stages at the 4 SEBlocks (unet1.conv2, unet2.conv2/3/4),
+    # stage k takes the tile state and the global SE mean of stage k-1,
+    # it returns the new state and the tensor whose global mean stage k+1 needs
+    def stage(self, k, state, se_mean):
+        if self.engine is not None: return self.engine.stage(k, state, se_mean)
+        if k==0:
+            tmp0,x_crop = self.unet1.forward_a(state)
+            return (tmp0,x_crop),x_crop
+        if k==1:
+            tmp0,x_crop = state
+            x_crop=self.unet1.conv2.seblock.forward_mean(x_crop,se_mean)
+            opt_unet1=self.unet1.forward_b(tmp0,x_crop)
+            del tmp0, x_crop
+            tmp_x1,tmp_x2 = self.unet2.forward_a(opt_unet1)
+            return (opt_unet1,tmp_x1,tmp_x2),tmp_x2
+        if k==2:
+            opt_unet1,tmp_x1,tmp_x2 = state
+            tmp_x2=self.unet2.conv2.seblock.forward_mean(tmp_x2,se_mean)
+            tmp_x3=self.unet2.forward_b(tmp_x2)
+            return (opt_unet1,tmp_x1,tmp_x2,tmp_x3),tmp_x3
+        if k==3:
+            opt_unet1,tmp_x1,tmp_x2,tmp_x3 = state
+            tmp_x3=self.unet2.conv3.seblock.forward_mean(tmp_x3,se_mean)
+            tmp_x4=self.unet2.forward_c(tmp_x2,tmp_x3)
+            del tmp_x2, tmp_x3
+            return (opt_unet1,tmp_x1,tmp_x4),tmp_x4
+        opt_unet1,tmp_x1,tmp_x4 = state
+        tmp_x4=self.unet2.conv4.seblock.forward_mean(tmp_x4,se_mean)
+        x0=self.unet2.forward_d(tmp_x1,tmp_x4)
+        del tmp_x1, tmp_x4
+        x1 = F.pad(opt_unet1,(-20,-20,-20,-20))
+        del opt_unet1
+        x_crop = torch.add(x0, x1)#x0是unet2的最终输出
+        del x0, x1
+        return self.tail(x_crop),None
+
+    def tile_mean(self, x):
+        if "Half" in x.type():  # torch.HalfTensor/torch.cuda.HalfTensor
+            return torch.mean(x.float(), dim=(2, 3),keepdim=True).half()
+        return torch.mean(x, dim=(2, 3),keepdim=True)
+
+    # tiles are independent within a stage, with workers > 1 they run on a thread pool
+    # and the torch intra-op threads are split between the workers
+    def map_tiles(self, fn, tiles, workers):
+        if workers <= 1 or len(tiles) <= 1: return [fn(ij) for ij in tiles]
+        grad, threads = torch.is_grad_enabled(), torch.get_num_threads()
+        cast, dtype = torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+        def run(ij):# grad mode and autocast are thread local
+            with torch.set_grad_enabled(grad), torch.autocast("cpu", dtype=dtype, enabled=cast): return fn(ij)
+        torch.set_num_threads(max(threads // workers, 1))
+        try:
+            with ThreadPoolExecutor(workers) as ex: return list(ex.map(run, tiles))
+        finally: torch.set_num_threads(threads)
+
+    # lowmem keeps only the per-tile SE statistics instead of every tile's intermediates,
+    # earlier stages of a tile are recomputed in every phase, costing about 3x compute
+    # tile_batch tiles are stacked into one tensor for every stage call
+    # with on_band the output is not assembled, every finished row of tiles is passed to
+    # on_band(band) top to bottom instead and forward returns None
+    # se_sample in (0, 1) estimates the global SE means from that share of the tile groups, spread
+    # evenly over the image, only those run the SE phases and keep intermediates, all other
+    # tiles then run end to end in a single pass (approximate, see se_sample.py)
+    def forward(self, x,tile_mode,lowmem=False,tile_workers=1,tile_batch=1,on_band=None,se_sample=0):#1.7G
+        n, c, h0, w0 = x.shape
+        x00 = x
+        s, p, a = self.scale, self.pad, self.align
+        if(tile_mode==0):#不tile
+            ph = ((h0 - 1) // a + 1) * a
+            pw = ((w0 - 1) // a + 1) * a
+            x = F.pad(x, (p, p + pw - w0, p, p + ph - h0), 'reflect')  # 需要保证被a整除
+            t0 = time()
+            x = self.full(x)
+            self.lap("full", t0)
+            self.report("full", 1, 1)
+            if (w0 != pw or h0 != ph): x = x[:, :, :h0 * s, :w0 * s]
+            if on_band is None: return self.skip(x, x00)
+            return on_band(self.skip(x, x00))
+        crop_size = self.crop_size(h0, w0, tile_mode)
         ph = ((h0 - 1) // crop_size[0] + 1) * crop_size[0]
         pw = ((w0 - 1) // crop_size[1] + 1) * crop_size[1]
-        x=F.pad(x,(18,18+pw-w0,18,18+ph-h0),'reflect')
+        x=F.pad(x,(p,p+pw-w0,p,p+ph-h0),'reflect')
         n,c,h,w=x.shape
-        xdev = x.device
-        se_mean0=torch.zeros((n,64,1,1)).to(xdev)
-        ishalf = "Half" in x.type()
-        if ishalf: se_mean0=se_mean0.half()
-        n_patch=0
-        tmp_dict={}
-        opt_res_dict={}
-        for i in range(0,h-36,crop_size[0]):
-            tmp_dict[i]={}
-            for j in range(0,w-36,crop_size[1]):
-                x_crop=x[:,:,i:i+crop_size[0]+36,j:j+crop_size[1]+36]
-                n,c1,h1,w1=x_crop.shape
-                tmp0,x_crop = self.unet1.forward_a(x_crop)
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(x_crop.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(x_crop, dim=(2, 3),keepdim=True)
-                se_mean0+=tmp_se_mean
-                n_patch+=1
-                tmp_dict[i][j]=(tmp0,x_crop)
-                del tmp0, x_crop
-        del x
-        se_mean0/=n_patch
-        se_mean1 = torch.zeros((n, 128, 1, 1)).to(xdev)#64#128#128#64
-        if ishalf: se_mean1=se_mean1.half()
-        for i in range(0,h-36,crop_size[0]):
-            for j in range(0,w-36,crop_size[1]):
-                tmp0, x_crop = tmp_dict[i][j]
-                del tmp_dict[i][j]
-                x_crop=self.unet1.conv2.seblock.forward_mean(x_crop,se_mean0)
-                opt_unet1=self.unet1.forward_b(tmp0,x_crop)
-                del tmp0, x_crop
-                tmp_x1,tmp_x2 = self.unet2.forward_a(opt_unet1)
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(tmp_x2.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(tmp_x2, dim=(2, 3),keepdim=True)
-                se_mean1+=tmp_se_mean
-                tmp_dict[i][j]=(opt_unet1,tmp_x1,tmp_x2)
-                del opt_unet1, tmp_x1, tmp_x2
-        se_mean1/=n_patch
-        se_mean0 = torch.zeros((n, 128, 1, 1)).to(xdev)  # 64#128#128#64
-        if ishalf: se_mean0=se_mean0.half()
-        for i in range(0,h-36,crop_size[0]):
-            for j in range(0,w-36,crop_size[1]):
-                opt_unet1,tmp_x1, tmp_x2=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                tmp_x2=self.unet2.conv2.seblock.forward_mean(tmp_x2,se_mean1)
-                tmp_x3=self.unet2.forward_b(tmp_x2)
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(tmp_x3.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(tmp_x3, dim=(2, 3),keepdim=True)
-                se_mean0+=tmp_se_mean
-                tmp_dict[i][j]=(opt_unet1,tmp_x1,tmp_x2,tmp_x3)
-                del opt_unet1, tmp_x1, tmp_x2, tmp_x3
-        se_mean0/=n_patch
-        se_mean1 = torch.zeros((n, 64, 1, 1)).to(xdev)  # 64#128#128#64
-        if ishalf: se_mean1=se_mean1.half()
-        for i in range(0,h-36,crop_size[0]):
-            for j in range(0,w-36,crop_size[1]):
-                opt_unet1,tmp_x1, tmp_x2,tmp_x3=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                tmp_x3=self.unet2.conv3.seblock.forward_mean(tmp_x3,se_mean0)
-                tmp_x4=self.unet2.forward_c(tmp_x2,tmp_x3)
-                del tmp_x2, tmp_x3
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(tmp_x4.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(tmp_x4, dim=(2, 3),keepdim=True)
-                se_mean1+=tmp_se_mean
-                tmp_dict[i][j]=(opt_unet1,tmp_x1,tmp_x4)
-                del opt_unet1, tmp_x1, tmp_x4
-        se_mean1/=n_patch
-        for i in range(0,h-36,crop_size[0]):
-            opt_res_dict[i]={}
-            for j in range(0,w-36,crop_size[1]):
-                opt_unet1,tmp_x1, tmp_x4=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                tmp_x4=self.unet2.conv4.seblock.forward_mean(tmp_x4,se_mean1)
-                x0=self.unet2.forward_d(tmp_x1,tmp_x4)
-                del tmp_x1, tmp_x4
-                x1 = F.pad(opt_unet1,(-20,-20,-20,-20))
-                del opt_unet1
-                x_crop = torch.add(x0, x1)#x0是unet2的最终输出
-                del x0, x1
-                opt_res_dict[i][j] = x_crop
-                del x_crop
-        del tmp_dict
-        torch.cuda.empty_cache()
-        res = torch.zeros((n, c, h * 2 - 72, w * 2 - 72)).to(xdev)
-        if ishalf: res=res.half()
-        for i in range(0,h-36,crop_size[0]):
-            for j in range(0,w-36,crop_size[1]):
-                res[:, :, i * 2:i * 2 + h1 * 2 - 72, j * 2:j * 2 + w1 * 2 - 72]=opt_res_dict[i][j]
-                del opt_res_dict[i][j]
-        del opt_res_dict
+        h1, w1 = crop_size[0]+2*p, crop_size[1]+2*p
+        tiles = [(i,j) for i in range(0,h-2*p,crop_size[0]) for j in range(0,w-2*p,crop_size[1])]
+        res = torch.zeros((n, c, h * s - 2*p*s, w * s - 2*p*s), dtype=x.dtype, device=x.device) if on_band is None else None
+        row0 = 0#output row of res[:, :, 0], the current band when streaming
+        means=[None]#means[k]是stage k需要的全局SE均值
+        # tiles have the same shape, every group of tile_batch tiles is stacked along n and runs as one batch,
+        # when streaming a group never spans two rows of tiles
+        cols = len(range(0,w-2*p,crop_size[1]))
+        rows = [tiles[r:r+cols] for r in range(0,len(tiles),cols)] if on_band is not None else [tiles]
+        groups = [tuple(row[g:g+tile_batch]) for row in rows for g in range(0,len(row),max(tile_batch,1))]
+        def crops(group):
+            if len(group)==1: return x[:,:,group[0][0]:group[0][0]+h1,group[0][1]:group[0][1]+w1]
+            return torch.cat([x[:,:,i:i+h1,j:j+w1] for i,j in group])
+        sampled = groups
+        if 0 < se_sample < 1:
+            k = max(round(len(groups) * se_sample), 1)
+            sampled = [groups[(2 * i + 1) * len(groups) // (2 * k)] for i in range(k)]
+        sampled_tiles = sum(len(group) for group in sampled)
+        tmp_dict={} if lowmem else {group:crops(group) for group in sampled}
+        done=[None]#done[0] counts the finished tiles of the current phase, next() is atomic
+        def run_group(group, k):#stage k of a group of tiles, result is the sum of their SE means, the last stage writes into res
+            g = len(group)
+            mean = lambda kk: means[kk].repeat(g,1,1,1) if g>1 and kk else means[kk]
+            if group not in tmp_dict:# lowmem or not sampled, earlier stages are recomputed
+                state = crops(group)
+                for kk in range(k): state,_ = self.stage(kk, state, mean(kk))
+            else: state = tmp_dict.pop(group)
+            state, t = self.stage(k, state, mean(k))
+            if self.progress is not None:
+                for _ in group: d = next(done[0])
+                self.report(f"se_phase{k}", d, len(tiles) if k==4 else sampled_tiles)
+            if k==4:
+                for (i,j),tile in zip(group, state.split(n)):
+                    res[:, :, i * s - row0:i * s - row0 + h1 * s - 2*p*s, j * s:j * s + w1 * s - 2*p*s]=tile
+                return None
+            if not lowmem: tmp_dict[group] = state
+            del state
+            t = self.tile_mean(t)
+            return t if g==1 else t.view(g,n,*t.shape[1:]).sum(0)
+        t0 = time()
+        for k in range(5):
+            done[0] = count(1)
+            if k==4 and on_band is not None:
+                for row in rows:
+                    i = row[0][0]
+                    row0, res = i * s, torch.empty((n, c, crop_size[0] * s, w * s - 2*p*s), dtype=x.dtype, device=x.device)
+                    self.map_tiles(lambda group: run_group(group, k), [g for g in groups if g[0][0] == i], tile_workers)
+                    hb = min(crop_size[0], h0 - i)
+                    on_band(self.skip(res[:, :, :hb * s, :w0 * s], x00[:, :, i:i + hb]))
+                    del res
+                self.lap("se_phase4", t0)
+                break
+            group_means = self.map_tiles(lambda group: run_group(group, k), groups if k==4 else sampled, tile_workers)
+            if k==4:
+                self.lap("se_phase4", t0)
+                break
+            acc = group_means[0]
+            for t in group_means[1:]: acc += t
+            means.append(acc/sampled_tiles)
+            del group_means, acc
+            t0 = self.lap(f"se_phase{k}", t0)
+        x = tmp_dict = None# the tile closures read them, del would make them undefined there
         torch.cuda.empty_cache()
-        if(w0!=pw or h0!=ph):res=res[:,:,:h0*2,:w0*2]
-        return res#
-class UpCunet3x(nn.Module):#完美tile，全程无损
+        if on_band is not None: return None
+        if(w0!=pw or h0!=ph):res=res[:,:,:h0*s,:w0*s]
+        return self.skip(res, x00)
+class UpCunet2x(UpCunet):
+    scale=2
+    pad=18
+    align=2
+
+    def __init__(self, in_channels=3, out_channels=3):
+        super(UpCunet2x, self).__init__()
+        self.unet1 = UNet1(in_channels, out_channels, deconv=True)
+        self.unet2 = UNet2(in_channels, out_channels, deconv=False)
+class UpCunet3x(UpCunet):
+    scale=3
+    pad=14
+    align=4
+
     def __init__(self, in_channels=3, out_channels=3):
         super(UpCunet3x, self).__init__()
         self.unet1 = UNet1x3(in_channels, out_channels, deconv=True)
         self.unet2 = UNet2(in_channels, out_channels, deconv=False)
+class UpCunet4x(UpCunet):
+    scale=4
+    pad=19
+    align=2
 
-    def forward(self, x,tile_mode):#1.7G
-        n, c, h0, w0 = x.shape
-        if(tile_mode==0):#不tile
-            ph = ((h0 - 1) // 4 + 1) * 4
-            pw = ((w0 - 1) // 4 + 1) * 4
-            x = F.pad(x, (14, 14 + pw - w0, 14, 14 + ph - h0), 'reflect')  # 需要保证被2整除
-            x = self.unet1.forward(x)
-            x0 = self.unet2.forward(x)
-            x1 = F.pad(x, (-20, -20, -20, -20))
-            x = torch.add(x0, x1)
-            del x0, x1
-            if (w0 != pw or h0 != ph): x = x[:, :, :h0 * 3, :w0 * 3]
-            return x
-        elif(tile_mode==1):# 对长边减半
-            if(w0>=h0):
-                crop_size_w=((w0-1)//8*8+8)//2#减半后能被4整除，所以要先被8整除
-                crop_size_h=(h0-1)//4*4+4#能被4整除
-            else:
-                crop_size_h=((h0-1)//8*8+8)//2#减半后能被4整除，所以要先被8整除
-                crop_size_w=(w0-1)//4*4+4#能被4整除
-            crop_size=(crop_size_h,crop_size_w)#6.6G
-        else:
-            s = tile_mode*2
-            crop_size=(((h0-1)//s*s+s)//tile_mode,((w0-1)//s*s+s)//tile_mode)
-        ph = ((h0 - 1) // crop_size[0] + 1) * crop_size[0]
-        pw = ((w0 - 1) // crop_size[1] + 1) * crop_size[1]
-        x=F.pad(x,(14,14+pw-w0,14,14+ph-h0),'reflect')
-        n,c,h,w=x.shape
-        xdev = x.device
-        se_mean0=torch.zeros((n,64,1,1)).to(xdev)
-        ishalf = "Half" in x.type()
-        if ishalf: se_mean0=se_mean0.half()
-        n_patch=0
-        tmp_dict={}
-        opt_res_dict={}
-        for i in range(0,h-28,crop_size[0]):
-            tmp_dict[i]={}
-            for j in range(0,w-28,crop_size[1]):
-                x_crop=x[:,:,i:i+crop_size[0]+28,j:j+crop_size[1]+28]
-                n,c1,h1,w1=x_crop.shape
-                tmp0,x_crop = self.unet1.forward_a(x_crop)
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(x_crop.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(x_crop, dim=(2, 3),keepdim=True)
-                se_mean0+=tmp_se_mean
-                n_patch+=1
-                tmp_dict[i][j]=(tmp0,x_crop)
-                del tmp0, x_crop
-        del x
-        se_mean0/=n_patch
-        se_mean1 = torch.zeros((n, 128, 1, 1)).to(xdev)#64#128#128#64
-        if ishalf: se_mean1=se_mean1.half()
-        for i in range(0,h-28,crop_size[0]):
-            for j in range(0,w-28,crop_size[1]):
-                tmp0, x_crop=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                x_crop=self.unet1.conv2.seblock.forward_mean(x_crop,se_mean0)
-                opt_unet1=self.unet1.forward_b(tmp0,x_crop)
-                del tmp0, x_crop
-                tmp_x1,tmp_x2 = self.unet2.forward_a(opt_unet1)
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(tmp_x2.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(tmp_x2, dim=(2, 3),keepdim=True)
-                se_mean1+=tmp_se_mean
-                tmp_dict[i][j]=(opt_unet1,tmp_x1,tmp_x2)
-                del opt_unet1, tmp_x1, tmp_x2
-        se_mean1/=n_patch
-        se_mean0 = torch.zeros((n, 128, 1, 1)).to(xdev)  # 64#128#128#64
-        if ishalf: se_mean0=se_mean0.half()
-        for i in range(0,h-28,crop_size[0]):
-            for j in range(0,w-28,crop_size[1]):
-                opt_unet1, tmp_x1, tmp_x2=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                tmp_x2=self.unet2.conv2.seblock.forward_mean(tmp_x2,se_mean1)
-                tmp_x3=self.unet2.forward_b(tmp_x2)
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(tmp_x3.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(tmp_x3, dim=(2, 3),keepdim=True)
-                se_mean0+=tmp_se_mean
-                tmp_dict[i][j]=(opt_unet1,tmp_x1,tmp_x2,tmp_x3)
-                del opt_unet1, tmp_x1, tmp_x2, tmp_x3
-        se_mean0/=n_patch
-        se_mean1 = torch.zeros((n, 64, 1, 1)).to(xdev)  # 64#128#128#64
-        if ishalf: se_mean1=se_mean1.half()
-        for i in range(0,h-28,crop_size[0]):
-            for j in range(0,w-28,crop_size[1]):
-                opt_unet1, tmp_x1, tmp_x2, tmp_x3=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                tmp_x3=self.unet2.conv3.seblock.forward_mean(tmp_x3,se_mean0)
-                tmp_x4=self.unet2.forward_c(tmp_x2,tmp_x3)
-                del tmp_x2, tmp_x3
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(tmp_x4.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(tmp_x4, dim=(2, 3),keepdim=True)
-                se_mean1+=tmp_se_mean
-                tmp_dict[i][j]=(opt_unet1,tmp_x1,tmp_x4)
-                del opt_unet1, tmp_x1, tmp_x4
-        se_mean1/=n_patch
-        for i in range(0,h-28,crop_size[0]):
-            opt_res_dict[i]={}
-            for j in range(0,w-28,crop_size[1]):
-                opt_unet1, tmp_x1, tmp_x4=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                tmp_x4=self.unet2.conv4.seblock.forward_mean(tmp_x4,se_mean1)
-                x0=self.unet2.forward_d(tmp_x1,tmp_x4)
-                del tmp_x1, tmp_x4
-                x1 = F.pad(opt_unet1,(-20,-20,-20,-20))
-                del opt_unet1
-                x_crop = torch.add(x0, x1)#x0是unet2的最终输出
-                del x0, x1
-                opt_res_dict[i][j]=x_crop#
-                del x_crop
-        del tmp_dict
-        torch.cuda.empty_cache()
-        res = torch.zeros((n, c, h * 3 - 84, w * 3 - 84)).to(xdev)
-        if ishalf: res=res.half()
-        for i in range(0,h-28,crop_size[0]):
-            for j in range(0,w-28,crop_size[1]):
-                res[:, :, i*3:i*3 + h1*3-84, j*3:j*3 + w1*3-84] = opt_res_dict[i][j]
-                del opt_res_dict[i][j]
-        del opt_res_dict
-        torch.cuda.empty_cache()
-        if(w0!=pw or h0!=ph):res=res[:,:,:h0*3,:w0*3]
-        return res
-class UpCunet4x(nn.Module):#完美tile，全程无损
     def __init__(self, in_channels=3, out_channels=3):
         super(UpCunet4x, self).__init__()
         self.unet1 = UNet1(in_channels, 64, deconv=True)
         self.unet2 = UNet2(64, 64, deconv=False)
         self.ps=nn.PixelShuffle(2)
         self.conv_final=nn.Conv2d(64,12,3,1,padding=0,bias=True)
-    def forward(self, x,tile_mode):
-        n, c, h0, w0 = x.shape
-        x00 = x
-        if(tile_mode==0):#不tile
-            ph = ((h0 - 1) // 2 + 1) * 2
-            pw = ((w0 - 1) // 2 + 1) * 2
-            x = F.pad(x, (19, 19 + pw - w0, 19, 19 + ph - h0), 'reflect')  # 需要保证被2整除
-            x = self.unet1.forward(x)
-            x0 = self.unet2.forward(x)
-            x1 = F.pad(x, (-20, -20, -20, -20))
-            x = torch.add(x0, x1)
-            del x0, x1
-            x=self.conv_final(x)
-            x=F.pad(x,(-1,-1,-1,-1))
-            x=self.ps(x)
-            if (w0 != pw or h0 != ph): x = x[:, :, :h0 * 4, :w0 * 4]
-            x+=F.interpolate(x00, scale_factor=4, mode='nearest')
-            del x00
-            return x
-        elif(tile_mode==1):# 对长边减半
-            if(w0>=h0):
-                crop_size_w=((w0-1)//4*4+4)//2#减半后能被2整除，所以要先被4整除
-                crop_size_h=(h0-1)//2*2+2#能被2整除
-            else:
-                crop_size_h=((h0-1)//4*4+4)//2#减半后能被2整除，所以要先被4整除
-                crop_size_w=(w0-1)//2*2+2#能被2整除
-            crop_size=(crop_size_h,crop_size_w)#6.6G
-        else:
-            s = tile_mode*2
-            crop_size=(((h0-1)//s*s+s)//tile_mode,((w0-1)//s*s+s)//tile_mode)
-        ph = ((h0 - 1) // crop_size[0] + 1) * crop_size[0]
-        pw = ((w0 - 1) // crop_size[1] + 1) * crop_size[1]
-        x=F.pad(x,(19,19+pw-w0,19,19+ph-h0),'reflect')
-        n,c,h,w=x.shape
-        xdev = x.device
-        se_mean0=torch.zeros((n,64,1,1)).to(xdev)
-        ishalf = "Half" in x.type()
-        if ishalf: se_mean0=se_mean0.half()
-        n_patch=0
-        tmp_dict={}
-        opt_res_dict={}
-        for i in range(0,h-38,crop_size[0]):
-            tmp_dict[i]={}
-            for j in range(0,w-38,crop_size[1]):
-                x_crop=x[:,:,i:i+crop_size[0]+38,j:j+crop_size[1]+38]
-                n,c1,h1,w1=x_crop.shape
-                tmp0,x_crop = self.unet1.forward_a(x_crop)
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(x_crop.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(x_crop, dim=(2, 3),keepdim=True)
-                se_mean0+=tmp_se_mean
-                n_patch+=1
-                tmp_dict[i][j]=(tmp0,x_crop)
-                del tmp0, x_crop
-        se_mean0/=n_patch
-        se_mean1 = torch.zeros((n, 128, 1, 1)).to(xdev)#64#128#128#64
-        if ishalf: se_mean1=se_mean1.half()
-        for i in range(0,h-38,crop_size[0]):
-            for j in range(0,w-38,crop_size[1]):
-                tmp0, x_crop=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                x_crop=self.unet1.conv2.seblock.forward_mean(x_crop,se_mean0)
-                opt_unet1=self.unet1.forward_b(tmp0,x_crop)
-                del tmp0, x_crop
-                tmp_x1,tmp_x2 = self.unet2.forward_a(opt_unet1)
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(tmp_x2.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(tmp_x2, dim=(2, 3),keepdim=True)
-                se_mean1+=tmp_se_mean
-                tmp_dict[i][j]=(opt_unet1,tmp_x1,tmp_x2)
-                del opt_unet1, tmp_x1, tmp_x2
-        se_mean1/=n_patch
-        se_mean0 = torch.zeros((n, 128, 1, 1)).to(xdev)  # 64#128#128#64
-        if ishalf: se_mean0=se_mean0.half()
-        for i in range(0,h-38,crop_size[0]):
-            for j in range(0,w-38,crop_size[1]):
-                opt_unet1,tmp_x1, tmp_x2=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                tmp_x2=self.unet2.conv2.seblock.forward_mean(tmp_x2,se_mean1)
-                tmp_x3=self.unet2.forward_b(tmp_x2)
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(tmp_x3.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(tmp_x3, dim=(2, 3),keepdim=True)
-                se_mean0+=tmp_se_mean
-                tmp_dict[i][j]=(opt_unet1,tmp_x1,tmp_x2,tmp_x3)
-                del opt_unet1, tmp_x1, tmp_x2, tmp_x3
-        se_mean0/=n_patch
-        se_mean1 = torch.zeros((n, 64, 1, 1)).to(xdev)  # 64#128#128#64
-        if ishalf: se_mean1=se_mean1.half()
-        for i in range(0,h-38,crop_size[0]):
-            for j in range(0,w-38,crop_size[1]):
-                opt_unet1, tmp_x1, tmp_x2, tmp_x3=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                tmp_x3=self.unet2.conv3.seblock.forward_mean(tmp_x3,se_mean0)
-                tmp_x4=self.unet2.forward_c(tmp_x2,tmp_x3)
-                del tmp_x2, tmp_x3
-                if ishalf:  # torch.HalfTensor/torch.cuda.HalfTensor
-                    tmp_se_mean = torch.mean(tmp_x4.float(), dim=(2, 3),keepdim=True).half()
-                else:
-                    tmp_se_mean = torch.mean(tmp_x4, dim=(2, 3),keepdim=True)
-                se_mean1+=tmp_se_mean
-                tmp_dict[i][j]=(opt_unet1,tmp_x1,tmp_x4)
-                del opt_unet1, tmp_x1, tmp_x4
-        se_mean1/=n_patch
-        for i in range(0,h-38,crop_size[0]):
-            opt_res_dict[i]={}
-            for j in range(0,w-38,crop_size[1]):
-                opt_unet1,tmp_x1, tmp_x4=tmp_dict[i][j]
-                del tmp_dict[i][j]
-                tmp_x4=self.unet2.conv4.seblock.forward_mean(tmp_x4,se_mean1)
-                x0=self.unet2.forward_d(tmp_x1,tmp_x4)
-                del tmp_x1, tmp_x4
-                x1 = F.pad(opt_unet1,(-20,-20,-20,-20))
-                del opt_unet1
-                x_crop = torch.add(x0, x1)#x0是unet2的最终输出
-                x_crop=self.conv_final(x_crop)
-                x_crop = F.pad(x_crop, (-1, -1, -1, -1))
-                x_crop=self.ps(x_crop)
-                opt_res_dict[i][j] = x_crop
-                del x_crop
-        del tmp_dict
-        torch.cuda.empty_cache()
-        res = torch.zeros((n, c, h * 4 - 152, w * 4 - 152)).to(xdev)
-        if ishalf: res=res.half()
-        for i in range(0,h-38,crop_size[0]):
-            for j in range(0,w-38,crop_size[1]):
-                # print(opt_res_dict[i][j].shape,res[:, :, i * 4:i * 4 + h1 * 4 - 144, j * 4:j * 4 + w1 * 4 - 144].shape)
-                res[:, :, i * 4:i * 4 + h1 * 4 - 152, j * 4:j * 4 + w1 * 4 - 152]=opt_res_dict[i][j]
-                del opt_res_dict[i][j]
-        del opt_res_dict
-        torch.cuda.empty_cache()
-        if(w0!=pw or h0!=ph):res=res[:,:,:h0*4,:w0*4]
+
+    def tail(self, x):
+        x=self.conv_final(x)
+        x=F.pad(x,(-1,-1,-1,-1))
+        return self.ps(x)
+
+    def skip(self, res, x00):
         res += F.interpolate(x00, scale_factor=4, mode='nearest')
-        del x00
-        return res#
+        return res
+# one UpCunet per scale built on the meta device, models whose weights are assigned are copies of it
+# and skip allocating and initializing parameters that are replaced right away
+_templates={}
+def template(scale):
+    if(scale not in _templates):_templates[scale]=eval("UpCunet%sx"%scale)().to("meta")
+    return deepcopy(_templates[scale])
 class RealWaifuUpScaler(object):
-    def __init__(self,scale,weight_path,half,device):
-        weight = torch.load(weight_path, map_location="cpu")
-        self.model=eval("UpCunet%sx"%scale)()
-        if(half==True):self.model=self.model.half().to(device)
-        else:self.model=self.model.to(device)
-        self.model.load_state_dict(weight, strict=True)
+    def __init__(self,scale,weight_path,half,device,weight=None):
+        # weight is an already loaded state dict, e.g. one in shared memory
+        shared = weight is not None
+        if not shared: weight = torch.load(weight_path, map_location="cpu")
+        # assign uses the given tensors as parameters instead of copying them, so shared and mapped weights stay shared
+        assign = shared and half==False and str(device).startswith("cpu")
+        if(assign):self.model=template(scale)
+        else:
+            self.model=eval("UpCunet%sx"%scale)()
+            if(half==True):self.model=self.model.half().to(device)
+            else:self.model=self.model.to(device)
+        self.model.load_state_dict(weight, strict=True, assign=assign)
         self.model.eval()
         self.half=half
         self.device=device
+        self.autocast=None# e.g. torch.bfloat16 runs the forward under cpu autocast
+
+    def forward(self, tensor, *args, **kw):
+        with torch.autocast("cpu", dtype=self.autocast or torch.bfloat16, enabled=self.autocast is not None):
+            return self.model(tensor, *args, **kw)
 
-    def np2tensor(self,np_frame):
-        if (self.half == False):return torch.from_numpy(np.transpose(np_frame, (2, 0, 1))).unsqueeze(0).to(self.device).float() / 255
-        else:return torch.from_numpy(np.transpose(np_frame, (2, 0, 1))).unsqueeze(0).to(self.device).half() / 255
+    # one frame or a list of same-shape frames, each is converted once straight into a preallocated tensor
+    def np2tensor(self,np_frames):
+        if isinstance(np_frames, np.ndarray): np_frames = [np_frames]
+        h, w, c = np_frames[0].shape
+        tensor = torch.empty((len(np_frames), c, h, w), dtype=torch.float16 if self.half else torch.float32, device=self.device)
+        for t, f in zip(tensor, np_frames): t.copy_(torch.from_numpy(f).permute(2, 0, 1))
+        return tensor.div_(255)
 
     def tensor2np(self,tensor):
-        if (self.half == False):return (np.transpose((tensor.data.squeeze()* 255.0).round().clamp_(0, 255).byte().cpu().numpy(), (1, 2, 0)))
-        else:return (np.transpose((tensor.data.squeeze().float()*255.0).round().clamp_(0, 255).byte().cpu().numpy(), (1, 2, 0)))
+        # the output tensor is not used afterwards, so it is scaled in place
+        tensor = tensor.data.squeeze(0).float()
+        return np.transpose(tensor.mul_(255.0).round_().clamp_(0, 255).byte().cpu().numpy(), (1, 2, 0))
+
+    # on_rows(rows) gets the output as cv2 images of consecutive rows, top to bottom
+    def stream(self, frame, tile_mode, on_rows, lowmem=False, tile_workers=1, tile_batch=1, se_sample=0):
+        with torch.no_grad():
+            t0 = time()
+            tensor = self.np2tensor(frame)
+            self.model.lap("np2tensor", t0)
+            self.forward(tensor, tile_mode, lowmem, tile_workers, tile_batch, lambda band: on_rows(self.tensor2np(band)), se_sample=se_sample)
+            del tensor
 
-    def __call__(self, frame,tile_mode):
+    def __call__(self, frame,tile_mode,lowmem=False,tile_workers=1,tile_batch=1,se_sample=0):
         with torch.no_grad():
+            t0 = time()
             tensor = self.np2tensor(frame)
-            result = self.tensor2np(self.model(tensor,tile_mode))
+            self.model.lap("np2tensor", t0)
+            result = self.forward(tensor,tile_mode,lowmem,tile_workers,tile_batch,se_sample=se_sample)
+            del tensor
+            t0 = time()
+            result = self.tensor2np(result)
+            self.model.lap("tensor2np", t0)
+        return result
+
+    # frames must share the same shape, they are stacked along n and run in one forward pass
+    def batch(self, frames, tile_mode,lowmem=False,tile_workers=1,tile_batch=1,se_sample=0):
+        with torch.no_grad():
+            t0 = time()
+            tensor = self.np2tensor(frames)
+            self.model.lap("np2tensor", t0)
+            result = self.forward(tensor,tile_mode,lowmem,tile_workers,tile_batch,se_sample=se_sample)
             del tensor
+            t0 = time()
+            result = [self.tensor2np(r) for r in result.split(1)]
+            self.model.lap("tensor2np", t0)
         return result
 
-if __name__ == "__main__":
-    ###########inference_img
-    import cv2, sys
-    from time import time
-    for weight_path,scale in [("weights_v3/up2x-latest-denoise3x.pth",2),("weights_v3/up3x-latest-denoise3x.pth",3),("weights_v3/up4x-latest-denoise3x.pth",4)]:
-        for tile_mode in [0,1,2,3,4]:
-            upscaler2x = RealWaifuUpScaler(scale, weight_path, half=False, device="cpu:0")
-            input_dir="%s/input_dir1"%root_path
-            output_dir="%s/opt-dir-all-test"%root_path
-            os.makedirs(output_dir,exist_ok=True)
-            for name in os.listdir(input_dir):
-                print(name)
-                tmp = name.split(".")
-                inp_path = os.path.join(input_dir, name)
-                suffix = tmp[-1]
-                prefix = ".".join(tmp[:-1])
-                tmp_path = os.path.join(root_path, "tmp", "%s.%s" % (int(time() * 1000000), suffix))
-                print(inp_path,tmp_path)
-                #支持中文路径
-                # os.link(inp_path, tmp_path)#win用硬链接
-                os.symlink(inp_path, tmp_path)#linux用软链接
-                frame = cv2.imread(tmp_path)[:, :, [2, 1, 0]]
-                t0 = time()
-                result = upscaler2x(frame, tile_mode=tile_mode)[:, :, ::-1]
-                t1 = time()
-                print(prefix, "done", t1 - t0)
-                tmp_opt_path = os.path.join(root_path, "tmp", "%s.%s" % (int(time() * 1000000), suffix))
-                cv2.imwrite(tmp_opt_path, result)
-                n=0
-                while(1):
-                    if(n==0):suffix="_%sx_tile%s.png" % (scale,tile_mode)
-                    else:suffix="_%sx_tile%s_%s.png" % (scale,tile_mode,n)#
-                    if(os.path.exists(os.path.join(output_dir, prefix + suffix))==False):break
-                    else:n+=1
-                final_opt_path=os.path.join(output_dir, prefix + suffix)
-                os.rename(tmp_opt_path,final_opt_path )
-                os.remove(tmp_path)
+# benchmarks on synthetic inputs: python3 bench.py --help
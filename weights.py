@@ -0,0 +1,127 @@
+from json import loads, dumps
+from mmap import mmap, ACCESS_COPY
+from os import replace
+from os.path import exists, getmtime
+from struct import pack, unpack
+from time import time, sleep
+import torch
+
+# Weights in the safetensors layout: 8 byte header length, json header of name -> dtype,
+# shape and data offsets, then the raw tensor data. load maps the file and every tensor is
+# a view of its bytes, nothing is copied or read up front. The mapping is private (copy on
+# write), processes mapping the same file share its pages in the page cache.
+# usage: python weights.py convert ["weights_v3/*.pth"]   writes a .safetensors next to every .pth
+#        python weights.py bench ["weights_v3/*.pth"] [port]   load times and time to the first request
+
+DTYPES = {"F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+          "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool}
+NAMES = {v: k for k, v in DTYPES.items()}
+
+# weights_v3/up2x-latest-no-denoise.pth -> weights_v3/up2x-latest-no-denoise.safetensors
+def mapped_path(weight_path: str) -> str:
+    return (weight_path[:-4] if weight_path.endswith(".pth") else weight_path) + ".safetensors"
+
+# the .pth name a mapped file stands for, models are named by it either way
+def weight_path_of(path: str) -> str:
+    return path[:-len(".safetensors")] + ".pth"
+
+# a model is available when its .pth or its mapped file exists
+def weight_exists(weight_path: str) -> bool:
+    return exists(weight_path) or exists(mapped_path(weight_path))
+
+# the file the weights of weight_path are read from, its .pth when there is one
+def weight_file(weight_path: str) -> str:
+    return weight_path if exists(weight_path) else mapped_path(weight_path)
+
+# whether weight_path loads from its mapped file, always when there is no .pth,
+# never when the .pth is newer (the mapped file was converted from an older .pth)
+def uses_mapped(weight_path: str, mapped: bool = True) -> bool:
+    if not exists(mapped_path(weight_path)): return False
+    if not exists(weight_path): return True
+    if mapped and getmtime(mapped_path(weight_path)) < getmtime(weight_path):
+        print(f"{mapped_path(weight_path)} is older than {weight_path}, loading the .pth, run weights.py convert")
+        return False
+    return mapped
+
+def save(state: dict, path: str) -> None:
+    header, offset = {}, 0
+    for k, t in state.items():
+        n = t.numel() * t.element_size()
+        header[k] = {"dtype": NAMES[t.dtype], "shape": list(t.shape), "data_offsets": [offset, offset + n]}
+        offset += n
+    h = dumps(header, separators=(",", ":")).encode()
+    h += b" " * (-len(h) % 8)# tensor data starts 8 byte aligned
+    with open(path + ".tmp", "wb") as f:
+        f.write(pack("<Q", len(h)) + h)
+        for t in state.values(): f.write(t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+    replace(path + ".tmp", path)
+
+# state dict of tensors viewing the mapped file, the mapping lives as long as they do
+def load(path: str) -> dict:
+    with open(path, "rb") as f: mm = mmap(f.fileno(), 0, access=ACCESS_COPY)
+    base = 8 + unpack("<Q", mm[:8])[0]
+    state = {}
+    for k, v in loads(mm[8:base]).items():
+        if k == "__metadata__": continue
+        dtype, (a, b) = DTYPES[v["dtype"]], v["data_offsets"]
+        if b == a: state[k] = torch.empty(v["shape"], dtype=dtype)
+        else: state[k] = torch.frombuffer(mm, dtype=dtype, count=(b - a) // dtype.itemsize, offset=base + a).view(v["shape"])
+    return state
+
+# the state dict of weight_path, from its mapped file when uses_mapped
+def load_weights(weight_path: str, mapped: bool = True) -> dict:
+    if uses_mapped(weight_path, mapped): return load(mapped_path(weight_path))
+    return torch.load(weight_path, map_location="cpu")
+
+def convert(weight_path: str) -> str:
+    state = torch.load(weight_path, map_location="cpu")
+    save(state, mapped_path(weight_path))
+    assert all(torch.equal(state[k], t) for k, t in load(mapped_path(weight_path)).items())
+    return mapped_path(weight_path)
+
+# seconds until a server started with env answers its first /scale request
+def first_request(port: int, env: dict, scale: int) -> float:
+    from subprocess import Popen, DEVNULL
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+    from os import environ
+    from sys import executable
+    from cv2 import imencode
+    import numpy as np
+    data = imencode(".png", np.random.randint(0, 256, (32, 32, 3), np.uint8))[1].tobytes()# never cached
+    t = time()
+    p = Popen([executable, __file__.replace("weights.py", "server.py"), "127.0.0.1", str(port)], env={**environ, **env}, stdout=DEVNULL, stderr=DEVNULL)
+    try:
+        while p.poll() == None:
+            try:
+                with urlopen(f"http://127.0.0.1:{port}/scale?scale={scale}&tile=0&format=png", data, timeout=60) as r:
+                    if r.status == 200: return time() - t
+            except HTTPError: raise
+            except OSError: sleep(0.05)# not listening yet
+        raise RuntimeError("server exited")
+    finally: p.kill()
+
+if __name__ == "__main__":
+    from sys import argv
+    from models import expand, weight_scale
+    from upcunet_v3 import RealWaifuUpScaler
+    paths = expand(argv[2] if len(argv) > 2 else "weights_v3/*.pth")
+    if len(argv) < 2 or argv[1] not in ("convert", "bench"): print("Usage: convert|bench [weights] [port]")
+    elif argv[1] == "convert":
+        for weight_path in paths: print(weight_path, "->", convert(weight_path))
+    else:
+        # each model loaded alone, then all of them, with torch.load and with the mapped files
+        load_model = lambda weight_path, mapped: RealWaifuUpScaler(weight_scale(weight_path), weight_path, half=False, device="cpu", weight=load_weights(weight_path) if mapped else None)
+        for mapped in (False, True): load_model(paths[0], mapped)# warm up
+        for mapped in (False, True):
+            t = time()
+            for weight_path in paths:
+                s = time()
+                load_model(weight_path, mapped)
+                print(f"{'mmap' if mapped else 'torch.load'} {weight_path}: {(time() - s) * 1000:.1f}ms")
+            print(f"{'mmap' if mapped else 'torch.load'} all {len(paths)}: {(time() - t) * 1000:.1f}ms")
+        port = int(argv[3]) if len(argv) > 3 else 8099
+        preload = argv[2] if len(argv) > 2 else "weights_v3/*.pth"
+        for mapped in ("0", "1"):
+            env = {"CUGAN_MODEL_PRELOAD": preload, "CUGAN_MMAP_WEIGHTS": mapped, "CUGAN_WORKERS": "1"}
+            print(f"first request, CUGAN_MMAP_WEIGHTS={mapped}: {first_request(port, env, weight_scale(paths[0])):.2f}s")
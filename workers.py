@@ -0,0 +1,146 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from os import getpid, getppid, replace, _exit
+from json import dump
+from threading import Thread
+from time import sleep
+from gevent import get_hub
+from models import ModelPool, load_shared
+from encoder import PngStream
+from animation import info, frames, writer, upscale
+from metrics import reset_peak_rss, peak_rss, observe_job
+import torch
+
+# model pool of the current process, every worker has its own
+_ups = None
+
+# workers are blocked reading the job queue and would outlive a killed server otherwise
+def _watch_parent(ppid: int) -> None:
+    while getppid() == ppid: sleep(1)
+    _exit(0)
+
+def _init(threads: int, weights: dict, preload: str, pool_kw: dict, ppid: int = 0) -> None:
+    global _ups
+    if ppid: Thread(target=_watch_parent, args=(ppid,), daemon=True).start()
+    if threads > 0: torch.set_num_threads(threads)
+    _ups = ModelPool(weights=weights, **pool_kw)
+    _ups.preload(preload)
+
+# the phase and tiles done of a running job are written to path as json, replaced atomically
+def _progress(path: str):
+    def write(phase: str, done: int, total: int) -> None:
+        with open(path + ".tmp", "w") as f: dump({"phase": phase, "tile": done, "tiles": total}, f)
+        replace(path + ".tmp", path)
+    return write
+
+# runs fn(m) for the model of key, result is (fn result, pid, pool info, job metrics)
+# job metrics are the stage timings of the model and the peak rss during the job,
+# with progress the model reports its progress into that file
+def _job(model: str, fn, progress: str = None) -> tuple:
+    reset_peak_rss()
+    m = _ups.get(model)
+    spans = []
+    m.model.timer = lambda stage, sec: spans.append((stage, sec))
+    if progress != None: m.model.progress = _progress(progress)
+    try: res = fn(m)
+    finally: m.model.timer = m.model.progress = None
+    return res, getpid(), _ups.info(), (spans, peak_rss())
+
+# frames, results are all cv2 images with the same shape
+def infer(key: tuple, frames: list, progress: str = None) -> tuple:
+    model, _, tile, _, opts = key
+    if len(frames) == 1: return _job(model, lambda m: [m(frames[0], tile_mode=tile, **dict(opts))], progress)
+    return _job(model, lambda m: m.batch(frames, tile_mode=tile, **dict(opts)), progress)
+
+# writes the output of one frame to path as a png, row band by row band while it is computed
+def stream(key: tuple, frame, path: str, effort: int = None) -> tuple:
+    model, scale, tile, _, opts = key
+    def run(m):
+        with open(path, "wb") as f:
+            png = PngStream(f, frame.shape[1] * scale, frame.shape[0] * scale, effort)
+            m.stream(frame, tile, png.write, **dict(opts))
+            png.close()
+    return _job(model, run)
+
+# upscales all frames of an animation into path as it is decoded, fmt is (format, quality, effort)
+def animate(key: tuple, data: bytes, kind: str, size: tuple, path: str, fmt: tuple, batch: int, max_frames: int, progress: str = None) -> tuple:
+    model, scale, tile, _, opts = key
+    w, h, _, fps, loop = info(data, kind)
+    def run(m):
+        with open(path, "wb") as f:
+            out = writer(f, path, fmt, size[0] * scale, size[1] * scale, fps, loop)
+            return upscale(m, frames(data, kind, None if size == (w, h) else size), out, tile, batch, max_frames, **dict(opts))
+    return _job(model, run, progress)
+
+# WorkerPool runs inference in forked worker processes so that the gevent loop is never blocked.
+# Preloaded weights are put into shared memory before forking, every worker maps the same pages.
+# With workers == 0 inference runs in the server process like before.
+# pool_kw are passed to the ModelPool of every worker.
+class WorkerPool(object):
+    def __init__(self, workers: int, threads: int, preload: str, **pool_kw):
+        self.workers = workers
+        self.threads = threads
+        self.preload = preload
+        self.pool_kw = pool_kw
+        self.executor = None
+        self.weights = None
+        self.started = False
+        self.stats = {"busy": 0, "jobs": 0, "restarts": 0, "models": {}}
+
+    # must be called before any other thread is running, fork copies only the calling thread
+    def start(self) -> None:
+        if self.started: return
+        self.started = True
+        if self.weights == None: self.weights = load_shared(self.preload, self.pool_kw.get("mapped", True))
+        if self.workers <= 0:
+            _init(0, self.weights, self.preload, self.pool_kw)
+            return
+        self.executor = ProcessPoolExecutor(self.workers, get_context("fork"), initializer=_init,
+                                            initargs=(self.threads, self.weights, self.preload, self.pool_kw, getpid()))
+        # forks all workers now and waits until every one has preloaded its models
+        for f in [self.executor.submit(getpid) for _ in range(self.workers)]: get_hub().threadpool.apply(f.result)
+        get_hub().threadpool.maxsize = max(get_hub().threadpool.maxsize, self.workers * 2)
+
+    # with progress the job writes its progress into that file, see _progress
+    def run(self, key: tuple, frames: list, progress: str = None) -> list:
+        return self.call(infer, key, frames, progress)
+
+    # output of a single frame written to path as it is computed, not batched
+    def stream(self, key: tuple, frame, path: str, effort: int = None) -> None:
+        self.call(stream, key, frame, path, effort)
+
+    # all frames of an animation upscaled into path, result is the frame counts of upscale()
+    def animate(self, key: tuple, data: bytes, kind: str, size: tuple, path: str, fmt: tuple, batch: int, max_frames: int, progress: str = None) -> dict:
+        return self.call(animate, key, data, kind, size, path, fmt, batch, max_frames, progress)
+
+    def call(self, fn, *args):
+        self.start()
+        self.stats["busy"] += 1
+        try:
+            if self.executor == None: res, pid, info, job = fn(*args)
+            # waiting in a native thread lets other greenlets run meanwhile
+            else:
+                executor = self.executor
+                try: res, pid, info, job = get_hub().threadpool.apply(executor.submit(fn, *args).result)
+                except BrokenProcessPool:
+                    self.restart(executor)
+                    raise
+        finally: self.stats["busy"] -= 1
+        observe_job(*job)
+        self.stats["jobs"] += 1
+        self.stats["models"][pid] = info
+        return res
+
+    # a worker that died (oom kill, segfault) breaks the executor for good: the jobs that were
+    # in flight fail and new workers are forked for the next ones
+    def restart(self, executor) -> None:
+        if executor is not self.executor: return# restarted by another failed job
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.stats["restarts"] += 1
+        self.stats["models"] = {}
+        self.started = False
+        self.start()
+
+    def info(self) -> dict:
+        return {"workers": self.workers, "threads": self.threads, **self.stats}